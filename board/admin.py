@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.utils.safestring import mark_safe
 
-from .models import Advertisement, Comment, Preferences, Image, Like, UserStat
+from .models import Advertisement, Comment, Preferences, Image, Like, UserStat, GenerationJob
 
 # admin.site.register(Advertisement)
 admin.site.register(Comment)
@@ -11,6 +11,12 @@ admin.site.register(Like)
 admin.site.register(UserStat)
 
 
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('advertisement', 'user', 'state', 'created_at', 'updated_at')
+    list_filter = ('state',)
+
+
 @admin.register(Advertisement)
 class AdvertisementAdmin(admin.ModelAdmin):
     readonly_fields = ['preview']
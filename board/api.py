@@ -0,0 +1,238 @@
+import hashlib
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import HttpRequest, JsonResponse
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition, require_safe
+
+from .models import Advertisement, Image, UserStat
+from .pagination import KeysetPaginator
+from .utilite import comments_page, read_stamps
+
+# Компактный JSON API доски только для чтения (/board/api/v1/...). Строки выбираются
+# через values() только с запрошенными полями (?fields=) и сериализуются без создания
+# объектов моделей. Поля ресурсов: имя в ответе -> поле запроса values().
+ADVERTISEMENT_FIELDS = {
+    'id': 'id',
+    'title': 'title',
+    'content': 'content',
+    'author_id': 'author_id',
+    'author': 'author__username',
+    'created_at': 'created_at',
+    'like_count': 'like_count',
+    'dislike_count': 'dislike_count',
+    'image': 'image',
+}
+COMMENT_FIELDS = {
+    'id': 'id',
+    'advertisement_id': 'advertisement_id',
+    'author_id': 'author_id',
+    'author': 'author__username',
+    'content': 'content',
+    'created_at': 'created_at',
+}
+STAT_FIELDS = {
+    'user_id': 'user_id',
+    'username': 'user__username',
+    **{counter: counter for counter in UserStat.counters},
+}
+# Поля ленты без текста объявления - по умолчанию лента отдается без него
+FEED_DEFAULT = [name for name in ADVERTISEMENT_FIELDS if name != 'content']
+# Дополнительное поле объявления: адреса картинок (отдельный запрос к Image)
+IMAGES = 'images'
+
+
+class ApiError(Exception):
+    """  Ошибка в параметрах запроса к API  """
+
+
+def media_url(name: str) -> str | None:
+    """  Адрес файла из MEDIA_ROOT или None для пустого поля  """
+    return default_storage.url(name) if name else None
+
+
+# Преобразование значений полей при сериализации
+CONVERTERS = {'image': media_url}
+
+
+def api_response(data: dict, status: int = 200) -> JsonResponse:
+    """
+    JSON-ответ без пробелов и с текстом в UTF-8 (без \\uXXXX) - так ответ короче и лучше сжимается
+    :param data: Данные ответа.
+    :param status: HTTP-статус.
+    """
+    return JsonResponse(data, status=status, json_dumps_params={'separators': (',', ':'), 'ensure_ascii': False})
+
+
+def api_error(message: str, status: int = 400) -> JsonResponse:
+    """  Ответ API с описанием ошибки  """
+    return api_response({'error': message}, status)
+
+
+def select_fields(request: HttpRequest, available: dict, default=None, extra: tuple = ()) -> list[str]:
+    """
+    Поля ответа из параметра ?fields= (через запятую)
+    :param request: HttpRequest - запрос пользователя.
+    :param available: Поля ресурса.
+    :param default: Поля по умолчанию (все поля ресурса, если не заданы).
+    :param extra: Дополнительные поля, которые не выбираются из основной таблицы.
+    :return: Список имен полей в порядке запроса.
+    """
+    value = request.GET.get('fields')
+    if not value:
+        return list(default or available)
+    fields = list(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in available and field not in extra]
+    if unknown or not fields:
+        raise ApiError(f'unknown fields: {",".join(unknown)}' if unknown else 'empty fields')
+    return fields
+
+
+def page_limit(request: HttpRequest) -> int:
+    """  Размер страницы из параметра ?limit= (не больше settings.API_MAX_PAGE_SIZE)  """
+    try:
+        limit = int(request.GET.get('limit', settings.API_PAGE_SIZE))
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    return min(max(limit, 1), settings.API_MAX_PAGE_SIZE)
+
+
+def columns(fields: list[str], available: dict, *required: str) -> list[str]:
+    """
+    Поля запроса values(): выбранные поля и поля, нужные для курсора
+    :param fields: Поля ответа.
+    :param available: Поля ресурса.
+    :param required: Поля запроса, которые выбираются всегда.
+    """
+    return list(dict.fromkeys([*required, *(available[field] for field in fields if field in available)]))
+
+
+def serialize(rows, fields: list[str], available: dict) -> list[dict]:
+    """
+    Строки values() в словари ответа: только выбранные поля под именами API
+    :param rows: Строки выборки values().
+    :param fields: Поля ответа.
+    :param available: Поля ресурса.
+    """
+    names = [(field, available[field], CONVERTERS.get(field)) for field in fields if field in available]
+    return [{name: convert(row[column]) if convert else row[column] for name, column, convert in names}
+            for row in rows]
+
+
+def api_etag(request: HttpRequest, key: str) -> str:
+    """
+    ETag ответа API по версии ресурса и полному адресу запроса (поля, курсор, размер страницы).
+    Ответы API не зависят от пользователя.
+    :param request: HttpRequest - запрос пользователя.
+    :param key: Ключ счетчика версии ресурса.
+    """
+    version, _ = read_stamps(request, [key])[key]
+    return hashlib.md5(f'{key}={version}|{request.get_full_path()}'.encode()).hexdigest()
+
+
+def api_view(key):
+    """
+    Декоратор представлений API: только GET/HEAD, ETag по версии ресурса, сжатие gzip
+    :param key: Функция (request, **kwargs) -> ключ счетчика версии ресурса.
+    """
+    def decorator(view):
+        view = condition(etag_func=lambda request, **kwargs: api_etag(request, key(request, **kwargs)))(view)
+        return gzip_page(require_safe(cache_control(public=True, no_cache=True)(view)))
+    return decorator
+
+
+def feed_key(request: HttpRequest) -> str:
+    """  Ключ версии ленты: общей или автора (?author=)  """
+    author = request.GET.get('author', '')
+    return f'author:{author}' if author.isdigit() else 'feed'
+
+
+@api_view(feed_key)
+def feed(request: HttpRequest) -> JsonResponse:
+    """
+    API - Лента объявлений, новые первыми.
+    :param request: HttpRequest - запрос (?fields=, ?limit=, ?after=/?before= - курсоры, ?author= - id автора).
+    :return: {'results': [...], 'next': курсор, 'previous': курсор}.
+    """
+    try:
+        fields = select_fields(request, ADVERTISEMENT_FIELDS, FEED_DEFAULT)
+        limit = page_limit(request)
+    except ApiError as er:
+        return api_error(str(er))
+    advertisements = Advertisement.objects.all()
+    author = request.GET.get('author')
+    if author:
+        if not author.isdigit():
+            return api_error('author must be an integer')
+        advertisements = advertisements.filter(author_id=author)
+    advertisements = advertisements.values(*columns(fields, ADVERTISEMENT_FIELDS, 'id'))
+    paginator = KeysetPaginator(advertisements, limit, count_key=author or 'all')
+    page = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+    return api_response({'results': serialize(page, fields, ADVERTISEMENT_FIELDS),
+                         'next': page.next_cursor(), 'previous': page.previous_cursor()})
+
+
+@api_view(lambda request, pk: f'adv:{pk}')
+def advertisement(request: HttpRequest, pk: int) -> JsonResponse:
+    """
+    API - Объявление.
+    :param request: HttpRequest - запрос (?fields=, в том числе images - адреса картинок объявления).
+    :param pk: id объявления.
+    :return: Поля объявления.
+    """
+    try:
+        fields = select_fields(request, ADVERTISEMENT_FIELDS, [*ADVERTISEMENT_FIELDS, IMAGES], extra=(IMAGES,))
+    except ApiError as er:
+        return api_error(str(er))
+    row = Advertisement.objects.filter(pk=pk).values(*columns(fields, ADVERTISEMENT_FIELDS, 'id')).first()
+    if row is None:
+        return api_error('not found', 404)
+    data = serialize([row], fields, ADVERTISEMENT_FIELDS)[0]
+    if IMAGES in fields:
+        data[IMAGES] = [media_url(name) for name in Image.objects.filter(advertisement_id=pk)
+                        .order_by('id').values_list('image', flat=True)]
+    return api_response(data)
+
+
+@api_view(lambda request, pk: f'adv:{pk}')
+def comments(request: HttpRequest, pk: int) -> JsonResponse:
+    """
+    API - Комментарии объявления в порядке добавления.
+    :param request: HttpRequest - запрос (?fields=, ?limit=, ?after= - курсор).
+    :param pk: id объявления.
+    :return: {'results': [...], 'next': курсор}.
+    """
+    try:
+        fields = select_fields(request, COMMENT_FIELDS)
+        limit = page_limit(request)
+    except ApiError as er:
+        return api_error(str(er))
+    rows, next_cursor = comments_page(pk, request.GET.get('after'), limit,
+                                      fields=columns(fields, COMMENT_FIELDS))
+    if not rows and not Advertisement.objects.filter(pk=pk).exists():
+        return api_error('not found', 404)
+    return api_response({'results': serialize(rows, fields, COMMENT_FIELDS), 'next': next_cursor})
+
+
+@api_view(lambda request: 'board')
+def stats(request: HttpRequest) -> JsonResponse:
+    """
+    API - Статистика пользователей по убыванию счетчика.
+    :param request: HttpRequest - запрос (?sort= - счетчик, ?fields=, ?limit=, ?after=/?before= - курсоры).
+    :return: {'results': [...], 'next': курсор, 'previous': курсор}.
+    """
+    sort = request.GET.get('sort') or UserStat.counters[0]
+    if sort not in UserStat.counters:
+        return api_error(f'sort must be one of: {",".join(UserStat.counters)}')
+    try:
+        fields = select_fields(request, STAT_FIELDS)
+        limit = page_limit(request)
+    except ApiError as er:
+        return api_error(str(er))
+    rows = UserStat.objects.values(*columns(fields, STAT_FIELDS, 'id', sort))
+    paginator = KeysetPaginator(rows, limit, count_key='stat', key=sort)
+    page = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+    return api_response({'results': serialize(page, fields, STAT_FIELDS),
+                         'next': page.next_cursor(), 'previous': page.previous_cursor()})
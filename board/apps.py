@@ -7,3 +7,7 @@ class BoardConfig(AppConfig):
 
     def ready(self):
         import board.signals
+        from django.core.signals import request_started
+        from board import jobs
+        # Незавершенные генерации продолжаются после перезапуска процесса (с первого запроса)
+        request_started.connect(jobs.resume_queue, dispatch_uid=jobs.RESUME_UID)
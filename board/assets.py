@@ -0,0 +1,174 @@
+import gzip
+import mimetypes
+import os
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, StaticFilesStorage, staticfiles_storage
+from django.http import FileResponse, HttpRequest, HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Статические файлы: имена с хешем содержимого и сжатые варианты (.gz, .br) создаются
+# при collectstatic, отдаются StaticFilesMiddleware по индексу в памяти.
+
+# Расширения файлов, которые имеет смысл сжимать (картинки уже сжаты)
+COMPRESSIBLE = ('.css', '.js', '.svg', '.ico', '.txt', '.html', '.json', '.map', '.xml')
+# Сжатые варианты в порядке предпочтения: кодировка, расширение файла
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Файлы с хешем в имени никогда не меняются
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def compress(path: str) -> list[str]:
+    """
+    Записать сжатые варианты файла рядом с ним (brotli - если установлен пакет Brotli).
+    Вариант не сохраняется, если он почти не меньше исходного файла.
+    :param path: Полный путь файла.
+    :return: Список созданных файлов.
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    packers = [('.gz', lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        packers.insert(0, ('.br', lambda raw: brotli.compress(raw, quality=11)))
+    made = []
+    for ext, pack in packers:
+        packed = pack(data)
+        if len(packed) < len(data) * 0.95:
+            tmp = f'{path}{ext}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as file:
+                file.write(packed)
+            os.replace(tmp, path + ext)
+            made.append(path + ext)
+    return made
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    """
+    Хранилище collectstatic: копии файлов с хешем содержимого в имени (ManifestStaticFilesStorage)
+    и заранее сжатые варианты текстовых файлов. Пока collectstatic не выполнялся
+    (разработка, тесты), адреса отдаются без хеша.
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = {*paths, *self.hashed_files.values()}
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE) and self.exists(name):
+                for path in compress(self.path(name)):
+                    yield name, os.path.relpath(path, self.location).replace('\\', '/'), True
+
+    def url(self, name, force=False):
+        try:
+            return super().url(name, force)
+        except ValueError:
+            return StaticFilesStorage.url(self, name)
+
+
+@dataclass
+class StaticFile:
+    """  Статический файл в индексе  """
+    path: str
+    size: int
+    content_type: str
+    etag: str
+    last_modified: str
+    cache_control: str
+    # Сжатые варианты: кодировка -> (путь, размер)
+    variants: dict = field(default_factory=dict)
+
+
+def collect_files() -> dict[str, str]:
+    """
+    Статические файлы: из STATIC_ROOT после collectstatic, иначе - через finders (разработка)
+    :return: Словарь {имя относительно STATIC_URL: полный путь}.
+    """
+    files = {}
+    root = str(settings.STATIC_ROOT or '')
+    if root and os.path.isdir(root):
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                files[os.path.relpath(path, root).replace('\\', '/')] = path
+        return files
+    for finder in finders.get_finders():
+        for name, storage in finder.list([]):
+            files.setdefault(name.replace('\\', '/'), storage.path(name))
+    return files
+
+
+def build_index() -> dict[str, StaticFile]:
+    """
+    Индекс статических файлов: адрес -> размер, тип, ETag, заголовки кеширования и сжатые
+    варианты. Строится один раз, после этого отдача файла не требует обращений к файловой системе,
+    кроме открытия самого файла.
+    """
+    files = collect_files()
+    hashed = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+    index = {}
+    for name, path in files.items():
+        if name.endswith(tuple(ext for _, ext in ENCODINGS)) and name.rsplit('.', 1)[0] in files:
+            continue
+        stat = os.stat(path)
+        variants = {encoding: (files[name + ext], os.stat(files[name + ext]).st_size)
+                    for encoding, ext in ENCODINGS if name + ext in files}
+        index[settings.STATIC_URL + name] = StaticFile(
+            path=path, size=stat.st_size,
+            content_type=mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            etag=f'"{stat.st_size:x}-{int(stat.st_mtime):x}"',
+            last_modified=http_date(stat.st_mtime),
+            cache_control=IMMUTABLE if name in hashed else f'public, max-age={settings.STATIC_MAX_AGE}',
+            variants=variants)
+    return index
+
+
+def serve(request: HttpRequest, entry: StaticFile) -> HttpResponse:
+    """
+    Отдать статический файл: сжатый вариант по Accept-Encoding, 304 по If-None-Match
+    :param request: HttpRequest - запрос пользователя.
+    :param entry: Файл из индекса.
+    """
+    accepted = {part.split(';')[0].strip() for part in request.headers.get('Accept-Encoding', '').split(',')}
+    encoding, (path, size) = next(((encoding, entry.variants[encoding]) for encoding, _ in ENCODINGS
+                                   if encoding in accepted and encoding in entry.variants),
+                                  (None, (entry.path, entry.size)))
+    etag = entry.etag if encoding is None else f'{entry.etag[:-1]}-{encoding}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=entry.content_type)
+        response['Content-Length'] = size
+        response['Last-Modified'] = entry.last_modified
+        if encoding:
+            response['Content-Encoding'] = encoding
+    response['ETag'] = etag
+    response['Cache-Control'] = entry.cache_control
+    if entry.variants:
+        response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+class StaticFilesMiddleware:
+    """
+    Отдача статических файлов до остальных middleware (сессии, авторизация) по индексу в памяти.
+    При DEBUG индекс строится на каждый запрос, чтобы видеть изменения файлов без перезапуска.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.index = build_index()
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if request.method in ('GET', 'HEAD') and request.path.startswith(settings.STATIC_URL):
+            entry = (build_index() if settings.DEBUG else self.index).get(request.path)
+            if entry is not None:
+                return serve(request, entry)
+        return self.get_response(request)
@@ -0,0 +1,205 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from .models import Advertisement, GenerationJob, Image
+from .utilite import advertisement_keys, kandinsky_query
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+RESUME_UID = 'board.jobs.resume_queue'
+
+
+def enqueue(advertisement: Advertisement, user) -> GenerationJob:
+    """
+    Поставить генерацию картинки для объявления в очередь. Если для объявления уже есть
+    незавершенное задание, новое не создается.
+    :param advertisement: Объявление.
+    :param user: Пользователь, запросивший генерацию.
+    :return: Задание на генерацию.
+    """
+    job = GenerationJob.objects.filter(advertisement=advertisement,
+                                       state__in=[GenerationJob.QUEUED, GenerationJob.RUNNING]).first()
+    if job:
+        # Задание могло остаться от перезапущенного процесса - обработчик должен его подхватить
+        wake_dispatcher()
+        return job
+    file_name_cut = (f'images/kandinsky/{datetime.now().year}_{datetime.now().month}/'
+                     f'img_{time.time_ns()}.jpg')
+    try:
+        with transaction.atomic():
+            image = Image.objects.create(advertisement=advertisement, user=user, image=file_name_cut)
+            job = GenerationJob.objects.create(advertisement=advertisement, user=user, image=image,
+                                               prompt=f'{advertisement.title} {advertisement.content}')
+    except IntegrityError:
+        # Параллельный запрос успел поставить задание раньше
+        job = GenerationJob.objects.filter(advertisement=advertisement,
+                                           state__in=[GenerationJob.QUEUED, GenerationJob.RUNNING]).first()
+    # Файл картинки появится после генерации, до этого вместо него показывается
+    # общая заглушка thumbnails.PLACEHOLDER
+    wake_dispatcher()
+    return job
+
+
+def wake_dispatcher():
+    """
+    Запустить или разбудить обработчик очереди в веб-процессе (режим KANDINSKY_WORKER = 'thread')
+    """
+    if settings.KANDINSKY_WORKER == 'thread':
+        start_dispatcher()
+
+
+def resume_queue(sender, **kwargs):
+    """
+    Обработчик первого запроса процесса (сигнал request_started): продолжить задания,
+    оставшиеся в очереди или прерванные перезапуском. Запросы к базе при запуске процесса
+    (AppConfig.ready) не выполняются, поэтому проверка отложена до первого запроса.
+    """
+    request_started.disconnect(resume_queue, dispatch_uid=RESUME_UID)
+    if settings.KANDINSKY_WORKER != 'thread':
+        return
+    try:
+        pending = GenerationJob.objects.filter(state__in=[GenerationJob.QUEUED, GenerationJob.RUNNING]).exists()
+    except Exception as er:
+        logging.error(f'Очередь генераций: {er}')
+        return
+    if pending:
+        start_dispatcher()
+
+
+def recover_stale() -> int:
+    """
+    Вернуть в очередь задания, зависшие в состоянии "выполняется" (например, процесс
+    был перезапущен во время генерации).
+    :return: Количество возвращенных заданий.
+    """
+    deadline = timezone.now() - timedelta(seconds=settings.KANDINSKY_JOB_TIMEOUT)
+    return GenerationJob.objects.filter(state=GenerationJob.RUNNING, updated_at__lt=deadline).update(
+        state=GenerationJob.QUEUED, updated_at=timezone.now())
+
+
+def claim_next() -> GenerationJob | None:
+    """
+    Забрать из очереди самое старое задание, если не превышен лимит одновременных генераций.
+    Задание переводится в состояние "выполняется" условным UPDATE, поэтому одно задание
+    не достанется двум обработчикам.
+    :return: Задание или None.
+    """
+    while True:
+        if GenerationJob.objects.filter(state=GenerationJob.RUNNING).count() >= settings.KANDINSKY_CONCURRENCY:
+            return None
+        job = GenerationJob.objects.filter(state=GenerationJob.QUEUED).order_by('id').first()
+        if job is None:
+            return None
+        if GenerationJob.objects.filter(id=job.id, state=GenerationJob.QUEUED).update(
+                state=GenerationJob.RUNNING, updated_at=timezone.now()):
+            job.state = GenerationJob.RUNNING
+            return job
+
+
+def run_job(job: GenerationJob):
+    """
+    Выполнить задание на генерацию и записать результат
+    :param job: Задание в состоянии "выполняется".
+    """
+    try:
+        if job.image is None:
+            raise FileNotFoundError('Картинка задания удалена')
+        path = os.path.join(settings.MEDIA_ROOT, job.image.image.name).replace("\\", "/")
+        dir_, file_name = os.path.split(path)
+        result = kandinsky_query(job.prompt, dir_, file_name,
+                                 advertisement_keys(job.advertisement_id, job.advertisement.author_id))
+        if result.startswith('Error'):
+            raise RuntimeError(result)
+        GenerationJob.objects.filter(id=job.id).update(state=GenerationJob.DONE, updated_at=timezone.now())
+    except Exception as er:
+        logging.error(f'Генерация {job.id}: {er}')
+        GenerationJob.objects.filter(id=job.id).update(state=GenerationJob.FAILED, error=str(er),
+                                                       updated_at=timezone.now())
+        # Картинка так и не появится - убираем ее из объявления, чтобы не ссылаться на пустой файл
+        if job.image_id:
+            Image.objects.filter(id=job.image_id).delete()
+    finally:
+        connection.close()
+
+
+class Dispatcher(threading.Thread):
+    """
+    Обработчик очереди генераций: забирает задания из базы и выполняет их в пуле
+    потоков фиксированного размера (settings.KANDINSKY_CONCURRENCY).
+    """
+
+    def __init__(self, idle_exit: bool = True):
+        """
+        :param idle_exit: Завершаться, когда очередь пуста (режим внутри веб-процесса).
+        """
+        super().__init__(name='kandinsky-dispatcher', daemon=True)
+        self.idle_exit = idle_exit
+        self.accepting = True
+        self.wakeup = threading.Event()
+        self.active = threading.Semaphore(settings.KANDINSKY_CONCURRENCY)
+
+    def run(self):
+        recover_stale()
+        with ThreadPoolExecutor(max_workers=settings.KANDINSKY_CONCURRENCY,
+                                thread_name_prefix='kandinsky') as pool:
+            while True:
+                if not self.active.acquire(timeout=settings.KANDINSKY_POLL_INTERVAL):
+                    continue
+                try:
+                    job = claim_next()
+                except Exception as er:
+                    logging.error(f'Очередь генераций: {er}')
+                    job = None
+                if job is not None:
+                    pool.submit(self.execute, job)
+                    continue
+                self.active.release()
+                # Задания прерванного процесса возвращаются в очередь, когда истечет их таймаут
+                recover_stale()
+                if self.idle_exit and self.finish():
+                    break
+                self.wakeup.wait(settings.KANDINSKY_POLL_INTERVAL)
+                self.wakeup.clear()
+        connection.close()
+
+    def finish(self) -> bool:
+        """
+        Перестать принимать задания, если нет ни ожидающих, ни выполняющихся заданий
+        (выполняющееся задание может оказаться зависшим, его нужно будет вернуть в очередь).
+        Проверка выполняется под той же блокировкой, что и запуск обработчика, поэтому
+        новое задание не потеряется.
+        """
+        with _dispatcher_lock:
+            if GenerationJob.objects.filter(state__in=[GenerationJob.QUEUED, GenerationJob.RUNNING]).exists():
+                return False
+            self.accepting = False
+            return True
+
+    def execute(self, job: GenerationJob):
+        try:
+            run_job(job)
+        finally:
+            self.active.release()
+            self.wakeup.set()
+
+
+def start_dispatcher():
+    """
+    Запустить обработчик очереди в текущем процессе, если он еще не запущен
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or not _dispatcher.accepting or not _dispatcher.is_alive():
+            _dispatcher = Dispatcher()
+            _dispatcher.start()
+        else:
+            _dispatcher.wakeup.set()
@@ -1,37 +1,163 @@
-import requests
+import aiohttp
 
 import json
 import time
 import base64
 import asyncio
-
-import time
+import random
+import tempfile
+import threading
 
 import os
 
 API_KEY = os.environ.get("API_KEY")
 SECRET_KEY = os.environ.get("SECRET_KEY")
+API_URL = os.environ.get("KANDINSKY_URL", "https://api-key.fusionbrain.ai/")
+
+# Таймаут одного HTTP-запроса к API (сек)
+TIMEOUT = float(os.environ.get("KANDINSKY_TIMEOUT", 30))
+# Количество повторов GET-запроса при сетевых ошибках и ответах 429/5xx (запуск генерации
+# повторяется, только если не удалось установить соединение)
+RETRIES = int(os.environ.get("KANDINSKY_RETRIES", 3))
+# Базовая задержка между повторами (сек), растет экспоненциально
+BACKOFF = float(os.environ.get("KANDINSKY_BACKOFF", 1))
+# Максимальное количество одновременных соединений с API
+CONNECTIONS = int(os.environ.get("KANDINSKY_CONNECTIONS", 10))
+# Время жизни закешированного id API-модели (сек)
+MODEL_TTL = float(os.environ.get("KANDINSKY_MODEL_TTL", 3600))
+
+_loop = None
+_loop_lock = threading.Lock()
+_api = None
+
+
+class ModelNotFound(Exception):
+    """  API не знает переданный id модели  """
 
 
 class Text2ImageAPI:
 
-    def __init__(self, url, api_key, secret_key):
+    def __init__(self, url, api_key, secret_key, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+                 model_ttl=MODEL_TTL):
         self.URL = url
         self.AUTH_HEADERS = {
             'X-Key': f'Key {api_key}',
             'X-Secret': f'Secret {secret_key}',
         }
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self._session = None
+        self._session_loop = None
+        self.model_ttl = model_ttl
+        self._model_id = None
+        self._model_expires = 0.0
+        self._model_refresh = None
 
-    def get_model(self):
+    async def session(self) -> aiohttp.ClientSession:
+        """
+        Общая HTTP-сессия с пулом соединений: TCP/TLS-соединения переиспользуются
+        между запросами и генерациями в пределах одного цикла событий
+        :return: Сессия aiohttp
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(headers=self.AUTH_HEADERS, timeout=self.timeout,
+                                                  connector=aiohttp.TCPConnector(limit=CONNECTIONS))
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """
+        Закрыть HTTP-сессию
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def request(self, method: str, path: str, **kwargs):
+        """
+        Запрос к API с повторами и экспоненциальной задержкой. GET повторяется при сетевых
+        ошибках и ответах 429/5xx. Остальные запросы (запуск генерации) не идемпотентны и
+        повторяются, только если соединение не было установлено и запрос не отправлен.
+        :param method: HTTP-метод
+        :param path: Путь относительно адреса API
+        :param kwargs: Параметры запроса aiohttp
+        :return: Разобранный JSON-ответ
+        """
+        session = await self.session()
+        idempotent = method in ('GET', 'HEAD')
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.request(method, self.URL + path, **kwargs) as response:
+                    if response.status != 429 and response.status < 500 or not idempotent:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status, message=response.reason)
+            except aiohttp.ClientConnectorError as er:
+                error = er
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as er:
+                if not idempotent:
+                    raise
+                error = er
+            if attempt == self.retries:
+                raise error
+            await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random() / 2))
+
+    async def get_model(self):
         """
         Запрос данных API-модели
         :return: id API-модели
         """
-        response = requests.get(self.URL + 'key/api/v1/models', headers=self.AUTH_HEADERS)
-        data = response.json()
+        data = await self.request('GET', 'key/api/v1/models')
         return data[0]['id']
 
-    def generate(self, prompt: str, model, images=1, width=1024, height=1024):
+    async def refresh_model(self):
+        """
+        Запросить id API-модели и запомнить его на model_ttl секунд
+        :return: id API-модели
+        """
+        self._model_id = await self.get_model()
+        self._model_expires = time.monotonic() + self.model_ttl
+        return self._model_id
+
+    async def model_id(self):
+        """
+        id API-модели из кеша. Если срок кеша истек, возвращается прежний id, а новый
+        запрашивается в фоне; запрос к API выполняется только при пустом кеше.
+        :return: id API-модели
+        """
+        if self._model_id is None or time.monotonic() >= self._model_expires:
+            # Одновременные генерации ждут один общий запрос модели
+            if self._model_refresh is None or self._model_refresh.done():
+                self._model_refresh = asyncio.create_task(self.refresh_model())
+                self._model_refresh.add_done_callback(lambda task: task.cancelled() or task.exception())
+            if self._model_id is None:
+                return await asyncio.shield(self._model_refresh)
+        return self._model_id
+
+    def invalidate_model(self):
+        """
+        Сбросить закешированный id API-модели
+        """
+        self._model_id = None
+        self._model_expires = 0.0
+
+    async def submit(self, prompt: str, **kwargs):
+        """
+        Отправка запроса на генерацию с закешированным id модели. Если API не знает
+        модель, кеш сбрасывается и запрос повторяется с новым id.
+        :param prompt: Строка запроса для генерации изображения
+        :param kwargs: Параметры generate
+        :return: id запроса для дальнейшего отслеживания
+        """
+        try:
+            return await self.generate(prompt, await self.model_id(), **kwargs)
+        except ModelNotFound:
+            self.invalidate_model()
+            return await self.generate(prompt, await self.model_id(), **kwargs)
+
+    async def generate(self, prompt: str, model, images=1, width=1024, height=1024):
         """
         Отправка запроса на генерацию
         :param prompt: Строка запроса для генерации изображения
@@ -51,12 +177,19 @@ class Text2ImageAPI:
             }
         }
 
-        data = {
-            'model_id': (None, model),
-            'params': (None, json.dumps(params), 'application/json')
-        }
-        response = requests.post(self.URL + 'key/api/v1/text2image/run', headers=self.AUTH_HEADERS, files=data)
-        data = response.json()
+        data = aiohttp.FormData()
+        data.add_field('model_id', str(model))
+        data.add_field('params', json.dumps(params), content_type='application/json')
+        try:
+            data = await self.request('POST', 'key/api/v1/text2image/run', data=data)
+        except aiohttp.ClientResponseError as er:
+            if er.status == 404:
+                raise ModelNotFound(model) from er
+            raise
+        if 'uuid' not in data:
+            if 'model' in json.dumps(data, ensure_ascii=False).lower():
+                raise ModelNotFound(model)
+            raise RuntimeError(f'Генерация не запущена: {data}')
         return data['uuid']
 
     async def check_generation(self, request_id, attempts=20, delay=10):
@@ -65,55 +198,104 @@ class Text2ImageAPI:
         :param request_id: id запроса
         :param attempts: Количество попыток проверки
         :param delay: Задержка времени между попытками
+        :return: Список картинок в base64
         """
         while attempts > 0:
-            response = requests.get(self.URL + 'key/api/v1/text2image/status/' + request_id, headers=self.AUTH_HEADERS)
-            data = response.json()
+            data = await self.request('GET', 'key/api/v1/text2image/status/' + request_id)
             if data['status'] == 'DONE':
                 return data['images']
+            if data['status'] == 'FAIL':
+                raise RuntimeError(f"Генерация не удалась: {data.get('errorDescription')}")
 
             attempts -= 1
-            # await time.sleep(delay)
             print('ожидаем....')
             await asyncio.sleep(delay)
+        raise TimeoutError(f'Генерация {request_id} не завершилась')
+
+
+def get_api() -> Text2ImageAPI:
+    """
+    Общий клиент API Kandinsky для процесса
+    :return: Клиент API
+    """
+    global _api
+    if _api is None:
+        _api = Text2ImageAPI(API_URL, API_KEY, SECRET_KEY)
+    return _api
 
 
-async def gen(prom: str, dirr="image", file_name=f"img_{time.time_ns()}.jpg") -> str:
+def event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Фоновый цикл событий процесса, в котором выполняются все генерации.
+    Один цикл обслуживает множество одновременных генераций.
+    :return: Цикл событий
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='kandinsky-loop', daemon=True).start()
+    return _loop
+
+
+def run(coro, timeout=None):
+    """
+    Выполнить корутину в фоновом цикле событий и дождаться результата
+    :param coro: Корутина
+    :param timeout: Максимальное время ожидания (сек)
+    :return: Результат корутины
+    """
+    return asyncio.run_coroutine_threadsafe(coro, event_loop()).result(timeout)
+
+
+async def gen(prom: str, dirr="image", file_name=f"img_{time.time_ns()}.jpg", api: Text2ImageAPI = None) -> str:
     """
     Генерация картинки через API Kandinsky
     :param prom: Строка запроса для генерации изображения
     :param dirr: Директория для сохранения сгенерированной картинки
     :param file_name: Имя файла сгенерированной картинки
+    :param api: Клиент API (по умолчанию общий клиент процесса)
     :return: Полное имя файла, куда была сохранена картинка
     """
     prom = ''.join([x for x in prom if 32 <= ord(x) <= 1103])[0:500]
     print(prom)
-    api = Text2ImageAPI('https://api-key.fusionbrain.ai/', API_KEY, SECRET_KEY)
-    # api2 =
-    model_id = api.get_model()
-    uuid = api.generate(prom, model_id)
+    api = api or get_api()
+    uuid = await api.submit(prom)
     images = await api.check_generation(uuid)
 
     # Здесь image_base64 - это строка с данными изображения в формате base64
     image_base64 = images[0]
 
-    # Декодируем строку base64 в бинарные данные
-    image_data = base64.b64decode(image_base64)
+    path = os.path.join(dirr, file_name).replace("\\", "/")
+    # Запись файла выполняется вне цикла событий, чтобы не задерживать другие генерации
+    await asyncio.to_thread(write_base64, image_base64, path)
+    return path
+
 
-    # Открываем файл для записи бинарных данных изображения
+def write_base64(image_base64: str, path: str, chunk_size: int = 64 * 1024):
+    """
+    Декодировать base64 частями во временный файл рядом с итоговым и атомарно
+    переименовать его. Читатели видят либо старый файл, либо полностью записанный новый,
+    а файл всегда оказывается именно по указанному пути.
+    :param image_base64: Картинка в base64
+    :param path: Полное имя итогового файла
+    :param chunk_size: Размер части base64 (кратен 4)
+    """
+    dir_ = os.path.dirname(path)
+    os.makedirs(dir_, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dir_, prefix='.', suffix='.tmp')
     try:
-        with open(os.path.join(dirr, file_name), "wb") as file:
-            file.write(image_data)
-    except:
-        try:
-            file_name = f"{file_name.split(' ')[0]}{time.time_ns()}.jpg"
-            with open(f"{dirr}/{file_name}", "wb") as file:
-                file.write(image_data)
-        except:
-            file_name = f'image{time.time_ns()}.jpg'
-            with open(f"{dirr}/{file_name}", "wb") as file:
-                file.write(image_data)
-    return f"{dirr}/{file_name}"
+        with os.fdopen(fd, 'wb') as file:
+            for start in range(0, len(image_base64), chunk_size):
+                file.write(base64.b64decode(image_base64[start:start + chunk_size]))
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
 
 
 if __name__ == '__main__':
@@ -121,12 +303,12 @@ if __name__ == '__main__':
         zapros = input("prompt: ")
 
         try:
-            os.makedirs(os.getcwd(, exist_ok=True).replace("\\", "/") + f'/' + zapros.replace("\n", " ").split(".")[0])
+            os.makedirs(os.getcwd().replace("\\", "/") + f'/' + zapros.replace("\n", " ").split(".")[0])
         except FileExistsError:
             print('exist')
 
         for j in range(4):
-            gen(zapros.replace("\n", " "), zapros.replace("\n", " ").split(".")[0])
+            run(gen(zapros.replace("\n", " "), zapros.replace("\n", " ").split(".")[0]))
             print(f"сделано {j + 1}")
 
         print("завершено")
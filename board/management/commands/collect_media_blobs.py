@@ -0,0 +1,14 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from board.storage import ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    help = 'Удалить файлы хранилища с адресацией по содержимому, на которые не осталось ссылок'
+
+    def handle(self, *args, **options):
+        if not isinstance(default_storage, ContentAddressedStorage):
+            self.stderr.write('Хранилище с адресацией по содержимому не включено (MEDIA_STORAGE=content)')
+            return
+        self.stdout.write(f'Удалено файлов: {default_storage.collect_garbage()}')
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from board.jobs import Dispatcher
+
+
+class Command(BaseCommand):
+    help = 'Обработчик очереди генерации картинок Kandinsky (settings.KANDINSKY_WORKER = "command")'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Обработчик очереди генераций запущен')
+        dispatcher = Dispatcher(idle_exit=False)
+        dispatcher.start()
+        try:
+            dispatcher.join()
+        except KeyboardInterrupt:
+            self.stdout.write('Остановлен')
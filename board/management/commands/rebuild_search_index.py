@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from board import search
+
+
+class Command(BaseCommand):
+    help = 'Заполнить полнотекстовый индекс поиска заново по объявлениям и комментариям'
+
+    def handle(self, *args, **options):
+        if not search.available():
+            self.stderr.write('Полнотекстовый индекс поддерживается только для SQLite')
+            return
+        with transaction.atomic():
+            count = search.rebuild()
+        self.stdout.write(f'Проиндексировано записей: {count}')
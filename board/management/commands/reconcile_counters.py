@@ -0,0 +1,135 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from board.models import Advertisement, Comment, Like, UserStat
+from board.utilite import advertisement_keys, bump_version
+
+
+def chunks(queryset, fields, size):
+    """
+    Строки таблицы частями по возрастанию id (без OFFSET и без загрузки всей таблицы)
+    :param queryset: Исходный запрос.
+    :param fields: Поля для values_list (первым - id).
+    :param size: Размер части.
+    :return: Генератор списков кортежей.
+    """
+    last = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last).order_by('id').values_list(*fields)[:size])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def grouped(queryset, field, ids, **aggregates) -> dict:
+    """
+    Сгруппированные агрегаты для части id одним запросом
+    :param queryset: Таблица, по которой считается агрегат.
+    :param field: Поле группировки.
+    :param ids: id части.
+    :param aggregates: Агрегаты (имя=выражение).
+    :return: Словарь {id: {имя: значение}}.
+    """
+    rows = queryset.filter(**{f'{field}__in': ids}).values(field).annotate(**aggregates).order_by()
+    return {row.pop(field): row for row in rows}
+
+
+class Command(BaseCommand):
+    help = ('Пересчитать денормализованные счетчики: лайки/дизлайки объявлений и статистику пользователей '
+            '(UserStat) по таблицам Like, Comment и Advertisement')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения, ничего не менять')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Количество строк в одной части')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.chunk_size = options['chunk_size']
+        advertisements = self.reconcile_advertisements()
+        users = self.reconcile_users()
+        action = 'Найдено расхождений' if self.dry_run else 'Исправлено'
+        self.stdout.write(f'{action}: объявлений {advertisements}, пользователей {users}')
+
+    def report(self, name: str, changes: dict):
+        self.stdout.write(f'{name}: ' + ', '.join(f'{field} {old} -> {new}' for field, (old, new) in changes.items()))
+
+    def reconcile_advertisements(self) -> int:
+        """
+        Сверить like_count/dislike_count объявлений с таблицей Like
+        :return: Количество объявлений с расхождениями.
+        """
+        fixed = 0
+        fields = ('id', 'author_id', 'like_count', 'dislike_count')
+        for chunk in chunks(Advertisement.objects.all(), ('id',), self.chunk_size):
+            # Счетчики и таблица Like читаются в той же транзакции, что и запись: оценка,
+            # поставленная между чтением и записью, не затирается устаревшим значением
+            with transaction.atomic():
+                ids = [row[0] for row in chunk]
+                rows = Advertisement.objects.filter(id__in=ids).order_by('id').values_list(*fields)
+                counts = grouped(Like.objects.all(), 'advertisement_id', ids,
+                                 like_count=Count('id', filter=Q(like_type=1)),
+                                 dislike_count=Count('id', filter=Q(like_type=0)))
+                changed, keys = [], []
+                for adv_id, author_id, like_count, dislike_count in rows:
+                    actual = counts.get(adv_id, {'like_count': 0, 'dislike_count': 0})
+                    changes = {field: (old, actual[field])
+                               for field, old in (('like_count', like_count), ('dislike_count', dislike_count))
+                               if old != actual[field]}
+                    if changes:
+                        self.report(f'Объявление {adv_id}', changes)
+                        changed.append(Advertisement(id=adv_id, **actual))
+                        keys += advertisement_keys(adv_id, author_id)
+                fixed += len(changed)
+                if changed and not self.dry_run:
+                    Advertisement.objects.bulk_update(changed, ['like_count', 'dislike_count'])
+                    bump_version(*dict.fromkeys(keys))
+        return fixed
+
+    def reconcile_users(self) -> int:
+        """
+        Сверить UserStat с таблицами Advertisement, Comment и Like. Недостающие строки
+        статистики создаются, если у пользователя есть хотя бы одно действие.
+        :return: Количество пользователей с расхождениями.
+        """
+        fixed = 0
+        for rows in chunks(get_user_model().objects.all(), ('id',), self.chunk_size):
+            # Агрегаты читаются в той же транзакции, что и запись статистики
+            with transaction.atomic():
+                ids = [row[0] for row in rows]
+                actual = {user_id: dict.fromkeys(UserStat.counters, 0) for user_id in ids}
+                for user_id, values in grouped(Advertisement.objects.all(), 'author_id', ids,
+                                               advertisement_count=Count('id')).items():
+                    actual[user_id].update(values)
+                for user_id, values in grouped(Comment.objects.all(), 'author_id', ids,
+                                               comment_count=Count('id')).items():
+                    actual[user_id].update(values)
+                for user_id, values in grouped(Like.objects.all(), 'user_id', ids,
+                                               like_count=Count('id', filter=Q(like_type=1)),
+                                               dislike_count=Count('id', filter=Q(like_type=0))).items():
+                    actual[user_id].update(values)
+                stats = {row[0]: row for row in UserStat.objects.filter(user_id__in=ids)
+                         .values_list('user_id', 'id', *UserStat.counters)}
+                changed, created = [], []
+                for user_id in ids:
+                    values = actual[user_id]
+                    if user_id not in stats:
+                        if any(values.values()):
+                            self.report(f'Пользователь {user_id} (нет статистики)',
+                                        {field: (0, value) for field, value in values.items() if value})
+                            created.append(UserStat(user_id=user_id, **values))
+                        continue
+                    old = dict(zip(UserStat.counters, stats[user_id][2:]))
+                    changes = {field: (old[field], values[field])
+                               for field in UserStat.counters if old[field] != values[field]}
+                    if changes:
+                        self.report(f'Пользователь {user_id}', changes)
+                        changed.append(UserStat(id=stats[user_id][1], user_id=user_id, **values))
+                fixed += len(changed) + len(created)
+                if (changed or created) and not self.dry_run:
+                    UserStat.objects.bulk_update(changed, UserStat.counters)
+                    UserStat.objects.bulk_create(created, ignore_conflicts=True)
+                    bump_version('board', *[f'author:{stat.user_id}' for stat in changed + created])
+        return fixed
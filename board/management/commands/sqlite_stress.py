@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from board import stress
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочная проверка SQLite: несколько процессов одновременно пишут во временную базу '
+            'в режимах settings.SQLITE_PROFILE и считают ошибки "database is locked"')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Количество процессов')
+        parser.add_argument('--iterations', type=int, default=200, help='Количество операций в каждом процессе')
+        parser.add_argument('--profile', choices=['default', 'concurrent'], action='append',
+                            help='Режим SQLite (по умолчанию оба)')
+
+    def handle(self, *args, **options):
+        for profile in options['profile'] or ['default', 'concurrent']:
+            result = stress.run(profile, options['workers'], options['iterations'])
+            self.stdout.write(f"{profile}: выполнено {result['ops']}, ошибок блокировки {result['locked']}, "
+                              f"время {result['seconds']:.2f} с, расхождений счетчиков {len(result['mismatches'])}")
@@ -0,0 +1,140 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpRequest, HttpResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+# Отдача медиафайлов (картинки объявлений, уменьшенные копии). Режим settings.MEDIA_SERVE:
+# 'x-accel' - файл отдает nginx по заголовку X-Accel-Redirect (internal location MEDIA_ACCEL_PREFIX),
+# 'x-sendfile' - файл отдает Apache/lighttpd по заголовку X-Sendfile,
+# 'django' - файл отдает Django: FileResponse через wsgi.file_wrapper (в gunicorn - sendfile без
+# копирования в Python), с поддержкой Range и условных запросов,
+# 'off' - /media/ отдает фронтовый сервер напрямую, маршрут в Django не подключается.
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class RangeFile:
+    """
+    Часть файла для FileResponse: читается не больше length байт, начиная с start.
+    fileno() оставлен, чтобы gunicorn отдал часть через sendfile (он берет текущую позицию
+    файла и Content-Length ответа).
+    """
+
+    def __init__(self, file, start: int, length: int):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if self.remaining <= 0:
+            return b''
+        data = self.file.read(self.remaining if size < 0 else min(size, self.remaining))
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self.file.fileno()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def seekable(self) -> bool:
+        return False
+
+    def close(self):
+        self.file.close()
+
+
+def byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Разобрать заголовок Range (один диапазон байт)
+    :param header: Значение заголовка.
+    :param size: Размер файла.
+    :return: (начало, длина); None - заголовок не поддерживается (отдается весь файл).
+    :raise ValueError: Диапазон за пределами файла.
+    """
+    match = _RANGE.fullmatch(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end - start + 1
+
+
+def not_modified(request: HttpRequest, etag: str, mtime: float) -> bool:
+    """  Условный запрос: у клиента актуальная копия файла  """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in if_none_match or if_none_match.strip() == '*'
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(mtime) <= since
+
+
+@require_safe
+def serve_media(request: HttpRequest, path: str) -> HttpResponse:
+    """
+    Представление - Медиафайл.
+    :param request: HttpRequest - запрос (поддерживаются Range, If-Range, If-None-Match, If-Modified-Since).
+    :param path: Имя файла относительно MEDIA_ROOT.
+    :return: Файл, его часть (206), 304 или ответ с заголовком для фронтового сервера.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        stat = os.stat(full_path)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404(path)
+    if not os.path.isfile(full_path):
+        raise Http404(path)
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    cache_control = f'public, max-age={settings.MEDIA_MAX_AGE}'
+    if settings.MEDIA_SERVE == 'x-accel':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+        response['Cache-Control'] = cache_control
+        return response
+    if settings.MEDIA_SERVE == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+        response['Cache-Control'] = cache_control
+        return response
+
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = http_date(stat.st_mtime)
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+    else:
+        start, length = 0, stat.st_size
+        header = request.headers.get('Range')
+        if_range = request.headers.get('If-Range')
+        if header and (if_range is None or if_range in (etag, last_modified)):
+            try:
+                part = byte_range(header, stat.st_size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{stat.st_size}'
+                return response
+            if part:
+                start, length = part
+        response = FileResponse(RangeFile(open(full_path, 'rb'), start, length), content_type=content_type)
+        response['Content-Length'] = length
+        response['Last-Modified'] = last_modified
+        response['Accept-Ranges'] = 'bytes'
+        if length != stat.st_size:
+            response.status_code = 206
+            response['Content-Range'] = f'bytes {start}-{start + length - 1}/{stat.st_size}'
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:26
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicate_likes(apps, schema_editor):
+    """  Оставить одну (последнюю) оценку пользователя на объявление  """
+    Like = apps.get_model('board', 'Like')
+    duplicates = (Like.objects.values('advertisement', 'user').annotate(rows=Count('id'), last=Max('id'))
+                  .filter(rows__gt=1))
+    for row in duplicates:
+        Like.objects.filter(advertisement=row['advertisement'], user=row['user']).exclude(id=row['last']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('board', '0017_generationjob'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='like',
+            constraint=models.UniqueConstraint(fields=('advertisement', 'user'), name='Одна оценка на объявление'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.4 on 2026-10-18 08:30
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('board', '0018_like_unique'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userstat',
+            index=models.Index(fields=['advertisement_count', 'id'], name='userstat_advertisement_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstat',
+            index=models.Index(fields=['comment_count', 'id'], name='userstat_comment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstat',
+            index=models.Index(fields=['like_count', 'id'], name='userstat_like_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userstat',
+            index=models.Index(fields=['dislike_count', 'id'], name='userstat_dislike_idx'),
+        ),
+    ]
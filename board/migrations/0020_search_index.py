@@ -0,0 +1,33 @@
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    """  Полнотекстовый индекс FTS5 (только SQLite) с заполнением из существующих данных  """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS board_search USING fts5("
+                          "kind UNINDEXED, object_id UNINDEXED, advertisement_id UNINDEXED, title, content, "
+                          "tokenize = 'unicode61 remove_diacritics 2')")
+    Advertisement = apps.get_model('board', 'Advertisement')
+    Comment = apps.get_model('board', 'Comment')
+    schema_editor.execute(f"INSERT INTO board_search (rowid, kind, object_id, advertisement_id, title, content) "
+                          f"SELECT id * 2, 'adv', id, id, title, content FROM {Advertisement._meta.db_table}")
+    schema_editor.execute(f"INSERT INTO board_search (rowid, kind, object_id, advertisement_id, title, content) "
+                          f"SELECT id * 2 + 1, 'comment', id, advertisement_id, '', content "
+                          f"FROM {Comment._meta.db_table}")
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS board_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('board', '0019_userstat_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:03
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('board', '0022_image_name_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='like',
+            name='like_advertisement_user_idx',
+        ),
+    ]
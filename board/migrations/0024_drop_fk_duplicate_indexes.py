@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:15
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('board', '0023_drop_like_advertisement_user_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='advertisement',
+            name='advertisement_author_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='image',
+            name='image_advertisement_idx',
+        ),
+    ]
@@ -14,7 +14,22 @@ def user_directory_path(instance, filename):
     return file
 
 
-class Advertisement(models.Model):
+class StatOwnerMixin:
+    """
+    Запоминает значения полей, от которых зависит статистика пользователя (автор, тип лайка),
+    на момент загрузки из базы. Сигналы сравнивают их с сохраняемыми значениями и не трогают
+    статистику при обычном редактировании.
+    """
+    stat_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.stat_owner = tuple(instance.__dict__.get(field) for field in cls.stat_fields)
+        return instance
+
+
+class Advertisement(StatOwnerMixin, models.Model):
     """  Модель таблица Объявления  """
     title = models.CharField(max_length=255)
     content = models.TextField()
@@ -24,6 +39,8 @@ class Advertisement(models.Model):
     dislike_count = models.IntegerField(default=0)
     image = models.ImageField(upload_to=user_directory_path, null=True, blank=True)
 
+    stat_fields = ('author_id',)
+
     class Meta:
         verbose_name = 'Объявления'
         verbose_name_plural = 'Объявления'
@@ -44,24 +61,34 @@ class Image(models.Model):
     class Meta:
         verbose_name = 'Изображения'
         verbose_name_plural = 'Изображения'
+        indexes = [
+            # Проверка, ссылаются ли другие картинки на файл, перед его удалением
+            models.Index(fields=['image'], name='image_name_idx'),
+        ]
 
 
-class Comment(models.Model):
+class Comment(StatOwnerMixin, models.Model):
     """  Модель таблицы комментариев к объявлениям  """
     advertisement = models.ForeignKey(Advertisement, related_name='comments', on_delete=models.CASCADE)
     author = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    stat_fields = ('author_id',)
+
     class Meta:
         verbose_name = 'Комментарии'
         verbose_name_plural = 'Комментарии'
+        indexes = [
+            # Комментарии объявления по времени
+            models.Index(fields=['advertisement', 'created_at'], name='comment_advertisement_idx'),
+        ]
 
     def __str__(self):
         return f'Комментарий от {self.author} на объявление "{self.advertisement}"'
 
 
-class Like(models.Model):
+class Like(StatOwnerMixin, models.Model):
     """  Модель лайков/дизлайков пользователей  """
     like_types = (
         (0, 'DisLike'),
@@ -73,9 +100,20 @@ class Like(models.Model):
     like_type = models.IntegerField(choices=like_types, default=1)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    stat_fields = ('user_id', 'like_type')
+
     class Meta:
         verbose_name = 'Лайки-дизлайки'
         verbose_name_plural = 'Лайки-дизлайки'
+        constraints = [
+            # Одна оценка пользователя на объявление: лайк и дизлайк переключаются в той же строке.
+            # Индекс ограничения используется и для поиска оценки при переключении (like_set)
+            models.UniqueConstraint(fields=['advertisement', 'user'], name='Одна оценка на объявление'),
+        ]
+        indexes = [
+            # Оценки пользователя (like_states, статистика)
+            models.Index(fields=['user', 'like_type'], name='like_user_type_idx'),
+        ]
 
     def __str__(self):
         return f'Объявление "{self.advertisement}", {self.get_like_type_display()} от {self.user}'
@@ -89,9 +127,18 @@ class UserStat(models.Model):
     dislike_count = models.IntegerField(default=0)
     comment_count = models.IntegerField(default=0)
 
+    counters = ('advertisement_count', 'comment_count', 'like_count', 'dislike_count')
+
     class Meta:
         verbose_name = 'Статистика'
         verbose_name_plural = 'Статистика'
+        # Сортировка и постраничный вывод статистики по (счетчик, id), место пользователя
+        indexes = [
+            models.Index(fields=['advertisement_count', 'id'], name='userstat_advertisement_idx'),
+            models.Index(fields=['comment_count', 'id'], name='userstat_comment_idx'),
+            models.Index(fields=['like_count', 'id'], name='userstat_like_idx'),
+            models.Index(fields=['dislike_count', 'id'], name='userstat_dislike_idx'),
+        ]
 
     def __str__(self):
         return (f'Пользователь {self.user}: '
@@ -118,3 +165,55 @@ class Preferences(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['user'], name='Одна запись на пользователя')
         ]
+
+
+class BoardVersion(models.Model):
+    """  Модель счетчиков версий данных доски (растут при каждом изменении)  """
+    key = models.CharField(max_length=64, unique=True)
+    version = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Версии данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.key}: {self.version}'
+
+
+class GenerationJob(models.Model):
+    """  Модель очереди заданий на генерацию картинок Kandinsky  """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    states = (
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    )
+
+    advertisement = models.ForeignKey(Advertisement, related_name='generation_jobs', on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    image = models.ForeignKey(Image, null=True, blank=True, on_delete=models.SET_NULL)
+    prompt = models.TextField()
+    state = models.CharField(max_length=16, choices=states, default=QUEUED)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Генерация картинок'
+        verbose_name_plural = 'Генерация картинок'
+        indexes = [
+            models.Index(fields=['state', 'id'], name='generationjob_state_idx'),
+        ]
+        constraints = [
+            # Не больше одного незавершенного задания на объявление - повторные нажатия не плодят задания
+            models.UniqueConstraint(fields=['advertisement'], condition=models.Q(state__in=['queued', 'running']),
+                                    name='Одна генерация на объявление'),
+        ]
+
+    def __str__(self):
+        return f'Генерация для "{self.advertisement}": {self.get_state_display()}'
@@ -0,0 +1,157 @@
+import base64
+import binascii
+from collections.abc import Sequence
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q, QuerySet
+
+
+def encode_cursor(*values: int) -> str:
+    """
+    Упаковать ключ строки (id или значение сортировки и id) в непрозрачный курсор для ссылок пагинации
+    :param values: Значения ключа.
+    :return: Строка курсора.
+    """
+    return base64.urlsafe_b64encode('.'.join(map(str, values)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str | None, size: int = 1) -> int | tuple[int, ...] | None:
+    """
+    Распаковать курсор, полученный из параметров запроса
+    :param token: Строка курсора.
+    :param size: Количество значений в ключе.
+    :return: id (при size=1), кортеж значений ключа или None, если курсор отсутствует или поврежден.
+    """
+    if not token:
+        return None
+    try:
+        values = tuple(int(value) for value in base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+                       .decode().split('.'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if len(values) != size:
+        return None
+    return values[0] if size == 1 else values
+
+
+class KeysetPaginator:
+    """
+    Пагинатор по ключу (id) для ленты объявлений. В отличие от
+    django.core.paginator.Paginator не выполняет COUNT(*) и OFFSET на каждом запросе:
+    страница выбирается условием по id, поэтому дальние страницы стоят столько же,
+    сколько первая. Общее количество берется из кеша и является оценкой.
+    Выборку можно сортировать и по другому целочисленному полю (по убыванию) - тогда ключом
+    служит пара (поле, id), и для нее нужен составной индекс.
+    """
+
+    def __init__(self, queryset: QuerySet, per_page: int, count_key: str, key: str = 'id'):
+        """
+        :param queryset: Выборка объявлений (сортировка задается пагинатором).
+        :param per_page: Количество объявлений на страницу.
+        :param count_key: Ключ кеша для оценки общего количества объявлений.
+        :param key: Поле сортировки (по убыванию, при равенстве - по id).
+        """
+        self.queryset = queryset
+        self.per_page = max(int(per_page), 1)
+        self.count_key = f'feed_count:{count_key}'
+        self.key = key
+        self.fields = ('id',) if key == 'id' else (key, 'id')
+
+    def cursor(self, row) -> str:
+        """  Курсор строки выборки (объекта модели или словаря из values())  """
+        if isinstance(row, dict):
+            return encode_cursor(*(row[field] for field in self.fields))
+        return encode_cursor(*(getattr(row, field) for field in self.fields))
+
+    def decode(self, token: str | None) -> tuple | None:
+        """  Значения ключа из курсора  """
+        values = decode_cursor(token, len(self.fields))
+        return (values,) if isinstance(values, int) else values
+
+    def beyond(self, values: tuple, older: bool) -> Q:
+        """
+        Условие "строки после ключа" в порядке сортировки ленты
+        :param values: Значения ключа.
+        :param older: True - строки дальше по ленте, False - ближе к началу.
+        """
+        lookup = 'lt' if older else 'gt'
+        if len(values) == 1:
+            return Q(**{f'id__{lookup}': values[0]})
+        value, pk = values
+        return Q(**{f'{self.key}__{lookup}': value}) | Q(**{self.key: value, f'id__{lookup}': pk})
+
+    @property
+    def count(self) -> int:
+        """
+        Оценка общего количества объявлений, обновляется не чаще FEED_COUNT_TIMEOUT секунд
+        """
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.queryset.order_by().count()
+            cache.set(self.count_key, count, settings.FEED_COUNT_TIMEOUT)
+        return count
+
+    def get_page(self, after: str | None = None, before: str | None = None) -> 'KeysetPage':
+        """
+        Получить страницу ленты относительно курсора
+        :param after: Курсор - объявления старше указанного (следующая страница).
+        :param before: Курсор - объявления новее указанного (предыдущая страница).
+        :return: Страница объявлений.
+        """
+        after_key, before_key = self.decode(after), self.decode(before)
+        if before_key is not None:
+            rows = list(self.queryset.filter(self.beyond(before_key, older=False))
+                        .order_by(*self.fields)[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next = True
+        else:
+            queryset = self.queryset.order_by(*(f'-{field}' for field in self.fields))
+            if after_key is not None:
+                queryset = queryset.filter(self.beyond(after_key, older=True))
+            rows = list(queryset[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous = after_key is not None
+        if not rows and (after_key is not None or before_key is not None):
+            # Курсор указывает за край ленты (например, объявления удалены) - отдаем первую страницу
+            return self.get_page()
+        return KeysetPage(rows, self, has_next, has_previous)
+
+
+class KeysetPage(Sequence):
+    """
+    Страница ленты с курсорами на соседние страницы
+    """
+    is_keyset = True
+
+    def __init__(self, object_list: list, paginator: KeysetPaginator, has_next: bool, has_previous: bool):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __repr__(self):
+        return f'<KeysetPage {len(self)} of ~{self.paginator.count}>'
+
+    def has_next(self) -> bool:
+        return self._has_next
+
+    def has_previous(self) -> bool:
+        return self._has_previous
+
+    def has_other_pages(self) -> bool:
+        return self._has_next or self._has_previous
+
+    def next_cursor(self) -> str | None:
+        return self.paginator.cursor(self.object_list[-1]) if self._has_next else None
+
+    def previous_cursor(self) -> str | None:
+        return self.paginator.cursor(self.object_list[0]) if self._has_previous else None
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest
+from django.template.loader import render_to_string
+
+from .utilite import read_stamps
+
+STAT_KEYS = ('page_hit', 'page_miss', 'card_hit', 'card_miss')
+
+
+def render_cache():
+    """  Кеш отрисованных страниц ленты и карточек объявлений  """
+    return caches[settings.RENDER_CACHE_ALIAS]
+
+
+def count(event: str, amount: int = 1):
+    """
+    Учесть попадания/промахи кеша
+    :param event: Название счетчика из STAT_KEYS.
+    :param amount: На сколько увеличить.
+    """
+    if not amount:
+        return
+    cache = render_cache()
+    key = f'stat:{event}'
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key, amount)
+
+
+def stats() -> dict:
+    """
+    Счетчики попаданий и промахов кеша
+    :return: Словарь {счетчик: значение}.
+    """
+    values = render_cache().get_many([f'stat:{event}' for event in STAT_KEYS])
+    return {event: values.get(f'stat:{event}', 0) for event in STAT_KEYS}
+
+
+def page_key(request: HttpRequest, feed_key: str, page_count: int) -> str | None:
+    """
+    Ключ кеша страницы ленты. Страницы одинаковы для всех анонимных пользователей
+    при одинаковых (лента, страница, размер страницы). Версия ленты входит в ключ,
+    поэтому любые изменения, отмеченные сигналами, дают новый ключ.
+    :param request: HttpRequest - запрос пользователя.
+    :param feed_key: Ключ счетчика версии ленты.
+    :param page_count: Количество объявлений на страницу.
+    :return: Ключ или None, если страница не кешируется.
+    """
+    if not settings.RENDER_CACHE or request.user.is_authenticated or 'day' in request.GET:
+        return None
+    version = read_stamps(request, [feed_key])[feed_key][0]
+    position = '/'.join(request.GET.get(param, '') for param in ('page', 'after', 'before'))
+    return f'page:{feed_key}:{version}:{settings.FEED_PAGINATION}:{page_count}:{position}'
+
+
+def render_cards(request: HttpRequest, advertisements) -> list[str]:
+    """
+    Отрисовать карточки объявлений ленты, используя кешированные фрагменты.
+    Версия объявления входит в ключ фрагмента.
+    :param request: HttpRequest - запрос пользователя.
+    :param advertisements: Объявления страницы (с подгруженными авторами и картинками).
+    :return: Список HTML карточек в порядке объявлений.
+    """
+    stamps = read_stamps(request, [f'adv:{adv.id}' for adv in advertisements])
+    keys = [f'card:{adv.id}:{stamps[f"adv:{adv.id}"][0]}' for adv in advertisements]
+    cache = render_cache() if settings.RENDER_CACHE else None
+    cached = cache.get_many(keys) if cache else {}
+    cards, missing = [], {}
+    for adv, key in zip(advertisements, keys):
+        if key not in cached:
+            cached[key] = missing[key] = render_to_string(
+                'board/advertisement_card.html', {'advertisement': adv, 'images': adv.images.all()})
+        cards.append(cached[key])
+    if cache:
+        cache.set_many(missing)
+        count('card_hit', amount=len(keys) - len(missing))
+        count('card_miss', amount=len(missing))
+    return cards
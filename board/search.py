@@ -0,0 +1,141 @@
+import re
+from dataclasses import dataclass
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import SafeString, mark_safe
+
+from .models import Advertisement, Comment
+
+# Полнотекстовый индекс SQLite FTS5 по заголовкам, тексту объявлений и комментариям
+# (таблица создается миграцией 0020_search_index).
+# rowid строки индекса: 2 * id для объявления, 2 * id + 1 для комментария.
+TABLE = 'board_search'
+ADVERTISEMENT = 'adv'
+COMMENT = 'comment'
+
+# Маркеры совпадений в snippet(): заменяются на <mark> после экранирования текста
+_MARK_START, _MARK_END = '\x02', '\x03'
+
+
+@dataclass
+class SearchResult:
+    """  Найденное объявление или комментарий  """
+    kind: str
+    object_id: int
+    advertisement_id: int
+    title: SafeString
+    snippet: SafeString
+    rank: float
+
+
+def available() -> bool:
+    """  Индекс поддерживается только в SQLite  """
+    return connection.vendor == 'sqlite'
+
+
+def match_query(text: str) -> str:
+    """
+    Превратить пользовательский запрос в выражение FTS5: каждое слово - отдельный
+    термин с поиском по префиксу. Операторы и кавычки из запроса не интерпретируются.
+    :param text: Строка поиска.
+    :return: Выражение MATCH или пустая строка.
+    """
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text)[:16])
+
+
+def highlight(text: str) -> SafeString:
+    """  Экранировать фрагмент и выделить совпадения  """
+    return mark_safe(escape(text or '').replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>'))
+
+
+def index_advertisement(advertisement: Advertisement):
+    """
+    Добавить или обновить объявление в индексе
+    :param advertisement: Объявление.
+    """
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [advertisement.id * 2])
+        cursor.execute(f'INSERT INTO {TABLE} (rowid, kind, object_id, advertisement_id, title, content) '
+                       f'VALUES (%s, %s, %s, %s, %s, %s)',
+                       [advertisement.id * 2, ADVERTISEMENT, advertisement.id, advertisement.id,
+                        advertisement.title, advertisement.content])
+
+
+def index_comment(comment: Comment):
+    """
+    Добавить или обновить комментарий в индексе
+    :param comment: Комментарий.
+    """
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [comment.id * 2 + 1])
+        cursor.execute(f'INSERT INTO {TABLE} (rowid, kind, object_id, advertisement_id, title, content) '
+                       f'VALUES (%s, %s, %s, %s, %s, %s)',
+                       [comment.id * 2 + 1, COMMENT, comment.id, comment.advertisement_id, '', comment.content])
+
+
+def remove(kind: str, object_id: int):
+    """
+    Удалить объявление или комментарий из индекса
+    :param kind: ADVERTISEMENT или COMMENT.
+    :param object_id: id объекта.
+    """
+    if not available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s',
+                       [object_id * 2 + (kind == COMMENT)])
+
+
+def rebuild() -> int:
+    """
+    Заполнить индекс заново из таблиц объявлений и комментариев
+    :return: Количество проиндексированных строк.
+    """
+    if not available():
+        return 0
+    advertisements = Advertisement._meta.db_table
+    comments = Comment._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+        cursor.execute(f'INSERT INTO {TABLE} (rowid, kind, object_id, advertisement_id, title, content) '
+                       f'SELECT id * 2, %s, id, id, title, content FROM {advertisements}', [ADVERTISEMENT])
+        count = cursor.rowcount
+        cursor.execute(f'INSERT INTO {TABLE} (rowid, kind, object_id, advertisement_id, title, content) '
+                       f"SELECT id * 2 + 1, %s, id, advertisement_id, '', content FROM {comments}", [COMMENT])
+        count += cursor.rowcount
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return count
+
+
+def search(text: str, limit: int = 20, offset: int = 0) -> list[SearchResult]:
+    """
+    Найти объявления и комментарии. Результаты упорядочены по релевантности (bm25),
+    совпадения в заголовке весят больше, чем в тексте.
+    :param text: Строка поиска.
+    :param limit: Количество результатов.
+    :param offset: Сколько результатов пропустить.
+    :return: Список результатов с выделенными фрагментами.
+    """
+    query = match_query(text)
+    if not query or not available():
+        return []
+    with connection.cursor() as cursor:
+        # Для комментариев заголовком служит название объявления
+        cursor.execute(
+            f'SELECT kind, object_id, advertisement_id, advertisement.title, '
+            f'highlight({TABLE}, 3, %s, %s), snippet({TABLE}, 4, %s, %s, %s, 16), '
+            f'bm25({TABLE}, 0, 0, 0, 10.0, 1.0) AS score '
+            f'FROM {TABLE} JOIN {Advertisement._meta.db_table} advertisement '
+            f'ON advertisement.id = {TABLE}.advertisement_id '
+            f'WHERE {TABLE} MATCH %s ORDER BY score LIMIT %s OFFSET %s',
+            [_MARK_START, _MARK_END, _MARK_START, _MARK_END, '…', query, limit, offset])
+        rows = cursor.fetchall()
+    return [SearchResult(kind, int(object_id), int(advertisement_id),
+                         highlight(title) if kind == ADVERTISEMENT else escape(advertisement_title),
+                         highlight(snippet), rank)
+            for kind, object_id, advertisement_id, advertisement_title, title, snippet, rank in rows]
@@ -1,44 +1,134 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Advertisement, Like, UserStat, Comment
+from .models import Advertisement, Like, Comment, Image, Preferences
+from .utilite import bump_version, advertisement_keys, change_user_stat
+from . import search
+from .storage import ContentAddressedStorage
+
+
+def update_stat(instance, counter, created, deleted):
+    """
+    Изменить статистику владельца объекта: +1 при создании, -1 при удалении. При редактировании
+    счетчики меняются только если сменился владелец или тип лайка (StatOwnerMixin.stat_owner).
+    :param instance: Сохраненный или удаленный объект.
+    :param counter: Функция (значения stat_fields) -> (id пользователя, имя счетчика).
+    :param created: Объект создан.
+    :param deleted: Объект удален.
+    """
+    owner = tuple(getattr(instance, field) for field in instance.stat_fields)
+    if deleted:
+        user_id, field = counter(*owner)
+        change_user_stat(user_id, upsert=False, **{field: -1})
+        return
+    previous = getattr(instance, 'stat_owner', None)
+    if created:
+        user_id, field = counter(*owner)
+        change_user_stat(user_id, **{field: 1})
+    elif previous is not None and previous != owner:
+        user_id, field = counter(*previous)
+        change_user_stat(user_id, upsert=False, **{field: -1})
+        user_id, field = counter(*owner)
+        change_user_stat(user_id, **{field: 1})
+    instance.stat_owner = owner
 
 
 @receiver(post_save, sender=Advertisement)
 @receiver(post_delete, sender=Advertisement)
-def create_notification_for_partner(sender, instance, created='delete', **kwargs):
-    if created:
-        count_avg = len(sender.objects.filter(author=instance.author))
-        avg = UserStat.objects.filter(user=instance.author)
-        if avg:
-            avg[0].advertisement_count = count_avg
-            avg[0].save()
-        else:
-            UserStat.objects.create(user=instance.author, advertisement_count=count_avg)
+def advertisement_stat(sender, instance, created=False, **kwargs):
+    """
+    Счетчик объявлений пользователя
+    """
+    update_stat(instance, lambda author_id: (author_id, 'advertisement_count'),
+                created, kwargs['signal'] is post_delete)
 
 
 @receiver(post_save, sender=Like)
 @receiver(post_delete, sender=Like)
-def create_notification_for_partner(sender, instance, created='delete', **kwargs):
-    if created:
-        count_like = len(sender.objects.filter(user=instance.user, like_type=1))
-        count_dislike = len(sender.objects.filter(user=instance.user, like_type=0))
-        avg = UserStat.objects.filter(user=instance.user)
-        if avg:
-            avg[0].like_count = count_like
-            avg[0].dislike_count = count_dislike
-            avg[0].save()
-        else:
-            UserStat.objects.create(user=instance.user, like_count=count_like, dislike_count=count_dislike)
+def like_stat(sender, instance, created=False, **kwargs):
+    """
+    Счетчики лайков/дизлайков пользователя
+    """
+    update_stat(instance, lambda user_id, like_type: (user_id, 'like_count' if like_type == 1 else 'dislike_count'),
+                created, kwargs['signal'] is post_delete)
 
 
 @receiver(post_save, sender=Comment)
 @receiver(post_delete, sender=Comment)
-def create_notification_for_partner(sender, instance, created='delete', **kwargs):
-    if created:
-        count_comment = len(sender.objects.filter(author=instance.author))
-        com = UserStat.objects.filter(user=instance.author)
-        if com:
-            com[0].comment_count = count_comment
-            com[0].save()
-        else:
-            UserStat.objects.create(user=instance.author, comment_count=count_comment)
+def comment_stat(sender, instance, created=False, **kwargs):
+    """
+    Счетчик комментариев пользователя
+    """
+    update_stat(instance, lambda author_id: (author_id, 'comment_count'),
+                created, kwargs['signal'] is post_delete)
+
+
+@receiver(post_save, sender=Advertisement)
+@receiver(post_delete, sender=Advertisement)
+def advertisement_changed(sender, instance, **kwargs):
+    bump_version(*advertisement_keys(instance.id, instance.author_id))
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def image_changed(sender, instance, **kwargs):
+    author_id = (Advertisement.objects.filter(id=instance.advertisement_id)
+                 .values_list('author_id', flat=True).first())
+    bump_version(*advertisement_keys(instance.advertisement_id, author_id))
+
+
+@receiver(post_delete, sender=Image)
+def image_file_deleted(sender, instance, **kwargs):
+    """
+    В хранилище с адресацией по содержимому (MEDIA_STORAGE = 'content') удалить файл картинки
+    после удаления строки, если на него не ссылаются другие картинки (поиск по индексу
+    image_name_idx). Файл удаляется после фиксации транзакции, чтобы откат не оставил строку без файла.
+    """
+    name, storage = instance.image.name, instance.image.storage
+    if (name and isinstance(storage, ContentAddressedStorage)
+            and not Image.objects.filter(image=name).exists()):
+        transaction.on_commit(lambda: storage.delete(name))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=Like)
+@receiver(post_delete, sender=Like)
+def advertisement_details_changed(sender, instance, **kwargs):
+    keys = ['board', f'adv:{instance.advertisement_id}']
+    if sender is Like:
+        # Счетчики лайков показываются в лентах (общей и автора)
+        author_id = (Advertisement.objects.filter(id=instance.advertisement_id)
+                     .values_list('author_id', flat=True).first())
+        keys = [*advertisement_keys(instance.advertisement_id, author_id), f'user:{instance.user_id}']
+    bump_version(*keys)
+
+
+@receiver(post_save, sender=Preferences)
+@receiver(post_delete, sender=Preferences)
+def preferences_changed(sender, instance, **kwargs):
+    bump_version(f'user:{instance.user_id}')
+
+
+@receiver(post_save, sender=Advertisement)
+@receiver(post_delete, sender=Advertisement)
+def advertisement_search(sender, instance, created=False, **kwargs):
+    """
+    Полнотекстовый индекс объявлений
+    """
+    if kwargs['signal'] is post_delete:
+        search.remove(search.ADVERTISEMENT, instance.id)
+    else:
+        search.index_advertisement(instance)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def comment_search(sender, instance, created=False, **kwargs):
+    """
+    Полнотекстовый индекс комментариев
+    """
+    if kwargs['signal'] is post_delete:
+        search.remove(search.COMMENT, instance.id)
+    else:
+        search.index_comment(instance)
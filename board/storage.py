@@ -0,0 +1,138 @@
+import contextlib
+import hashlib
+import os
+import tempfile
+
+from django.core.files import locks
+from django.core.files.storage import FileSystemStorage
+
+# Хранилище медиафайлов с адресацией по содержимому (settings.MEDIA_STORAGE = 'content').
+# Каждый уникальный файл хранится один раз: blobs/<2 символа>/<2 символа>/<sha256>.
+# Файлы с прежними именами (images/user_<id>/...) - жесткие ссылки на blob, поэтому адреса
+# и код, который работает с путями в MEDIA_ROOT (уменьшенные копии), не меняются.
+# Счетчик ссылок на blob - количество жестких ссылок файловой системы (st_nlink):
+# blob удаляется вместе с последним файлом, который на него ссылается. MEDIA_ROOT должен
+# находиться на файловой системе с поддержкой жестких ссылок.
+BLOBS = 'blobs'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage без повторного хранения одинаковых файлов. При сохранении содержимое
+    частями пишется во временный файл и одновременно хешируется, затем становится blob
+    (или удаляется, если такой blob уже есть), а под запрошенным именем создается жесткая ссылка.
+    """
+
+    def blob_name(self, digest: str) -> str:
+        """  Имя blob относительно MEDIA_ROOT по хешу содержимого  """
+        return f'{BLOBS}/{digest[:2]}/{digest[2:4]}/{digest}'
+
+    def digest(self, name: str) -> str:
+        """  SHA-256 содержимого файла  """
+        sha = hashlib.sha256()
+        with open(self.path(name), 'rb') as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Блокировка хранилища (между процессами - файловая): создание ссылок на blob и удаление
+        blob без ссылок не должны пересекаться, иначе blob может пропасть между проверкой
+        и созданием ссылки.
+        """
+        os.makedirs(self.path(BLOBS), exist_ok=True)
+        with open(self.path(f'{BLOBS}/.lock'), 'wb') as file:
+            locks.lock(file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(file)
+
+    def _write_temp(self, content) -> tuple[str, str]:
+        """
+        Записать содержимое во временный файл, одновременно вычисляя хеш
+        :param content: Файл (File).
+        :return: Полный путь временного файла и имя blob.
+        """
+        tmp_dir = self.path(f'{BLOBS}/tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        sha = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    sha.update(chunk)
+                    file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp, self.file_permissions_mode)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return tmp, self.blob_name(sha.hexdigest())
+
+    def _save(self, name, content):
+        tmp, blob = self._write_temp(content)
+        try:
+            os.makedirs(os.path.dirname(self.path(blob)), exist_ok=True)
+            os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+            with self._locked():
+                try:
+                    # link, а не replace: blob, на который уже есть ссылки, не подменяется
+                    os.link(tmp, self.path(blob))
+                except FileExistsError:
+                    pass
+                while True:
+                    try:
+                        os.link(self.path(blob), self.path(name))
+                    except FileExistsError:
+                        name = self.get_available_name(name)
+                    else:
+                        break
+        finally:
+            os.remove(tmp)
+        return os.path.relpath(self.path(name), self.location).replace('\\', '/')
+
+    def delete(self, name):
+        """
+        Удалить файл; blob удаляется, если на него больше нет ссылок
+        :param name: Имя файла относительно MEDIA_ROOT.
+        """
+        try:
+            stat = os.stat(self.path(name))
+        except FileNotFoundError:
+            return
+        blob = None
+        if stat.st_nlink > 1 and not name.startswith(f'{BLOBS}/'):
+            blob = self.path(self.blob_name(self.digest(name)))
+        with self._locked():
+            super().delete(name)
+            try:
+                if blob and os.path.samestat(os.stat(blob), stat) and os.stat(blob).st_nlink == 1:
+                    os.remove(blob)
+            except FileNotFoundError:
+                pass
+
+    def references(self, name: str) -> int:
+        """  Количество файлов, ссылающихся на тот же blob, что и name  """
+        return os.stat(self.path(name)).st_nlink - 1
+
+    def collect_garbage(self) -> int:
+        """
+        Удалить blob без ссылок (например, если файл удалили в обход хранилища)
+        :return: Количество удаленных blob.
+        """
+        removed = 0
+        with self._locked():
+            for root, _, files in os.walk(self.path(BLOBS)):
+                if os.path.basename(root) == 'tmp':
+                    continue
+                for file in files:
+                    path = os.path.join(root, file)
+                    if file != '.lock' and os.stat(path).st_nlink == 1:
+                        os.remove(path)
+                        removed += 1
+        return removed
@@ -0,0 +1,120 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+# Нагрузочная проверка SQLite: несколько процессов одновременно ставят лайки и пишут
+# комментарии в одну базу, как воркеры gunicorn. Каждый процесс настраивает Django сам
+# (переменные окружения SQLITE_PATH и SQLITE_PROFILE читаются в settings), поэтому модели
+# импортируются только внутри функций.
+
+USERS = 20
+ADVERTISEMENTS = 10
+
+
+def _setup(db_path: str, profile: str):
+    os.environ['SQLITE_PATH'] = db_path
+    os.environ['SQLITE_PROFILE'] = profile
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'board_project.settings')
+    import django
+    django.setup()
+
+
+def prepare(db_path: str, profile: str):
+    """
+    Создать базу для проверки: схема, пользователи и объявления
+    :param db_path: Путь файла базы.
+    :param profile: Режим SQLite (settings.SQLITE_PROFILE).
+    """
+    _setup(db_path, profile)
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from .models import Advertisement
+
+    call_command('migrate', verbosity=0)
+    users = User.objects.bulk_create([User(username=f'stress_{i}') for i in range(USERS)])
+    Advertisement.objects.bulk_create([Advertisement(title=f'Объявление {i}', content='Текст', author=users[0])
+                                       for i in range(ADVERTISEMENTS)])
+
+
+def work(db_path: str, profile: str, seed: int, iterations: int, start_at: float) -> dict:
+    """
+    Серия записей одного процесса: переключение лайков и комментарии
+    :param db_path: Путь файла базы.
+    :param profile: Режим SQLite.
+    :param seed: Начальное значение генератора случайных чисел.
+    :param iterations: Количество операций.
+    :param start_at: Время начала (time.time()), общее для всех процессов.
+    :return: Словарь {'ops': выполнено, 'locked': ошибок блокировки, 'seconds': время}.
+    """
+    _setup(db_path, profile)
+    from types import SimpleNamespace
+    from django.contrib.auth.models import User
+    from django.db import OperationalError, connection, transaction
+    from .models import Advertisement, Comment
+    from .utilite import like_set
+
+    rnd = random.Random(seed)
+    users = list(User.objects.all())
+    advertisements = list(Advertisement.objects.values_list('id', flat=True))
+    result = {'ops': 0, 'locked': 0}
+    time.sleep(max(start_at - time.time(), 0))
+    start = time.monotonic()
+    for _ in range(iterations):
+        user, adv_id = rnd.choice(users), rnd.choice(advertisements)
+        try:
+            # Как запрос к представлению: чтение объявления и запись в одной транзакции
+            with transaction.atomic():
+                Advertisement.objects.get(id=adv_id)
+                if rnd.random() < 0.8:
+                    like_set(SimpleNamespace(user=user), adv_id, rnd.randint(0, 1))
+                else:
+                    Comment.objects.create(advertisement_id=adv_id, author=user, content='Нагрузка')
+            result['ops'] += 1
+        except OperationalError as er:
+            if 'locked' not in str(er):
+                raise
+            result['locked'] += 1
+    result['seconds'] = time.monotonic() - start
+    connection.close()
+    return result
+
+
+def verify(db_path: str, profile: str) -> list[str]:
+    """
+    Сверить счетчики лайков после нагрузки с таблицей Like
+    :return: Список расхождений.
+    """
+    _setup(db_path, profile)
+    from django.db.models import Count, Q
+    from .models import Advertisement
+
+    rows = Advertisement.objects.annotate(actual_likes=Count('likes', filter=Q(likes__like_type=1)),
+                                          actual_dislikes=Count('likes', filter=Q(likes__like_type=0)))
+    return [f'Объявление {adv.id}: {adv.like_count}/{adv.dislike_count} != {adv.actual_likes}/{adv.actual_dislikes}'
+            for adv in rows if (adv.like_count, adv.dislike_count) != (adv.actual_likes, adv.actual_dislikes)]
+
+
+def run(profile: str, workers: int = 8, iterations: int = 200) -> dict:
+    """
+    Провести проверку на временной базе
+    :param profile: Режим SQLite ('concurrent' или 'default').
+    :param workers: Количество процессов.
+    :param iterations: Количество операций в каждом процессе.
+    :return: Итог: выполнено операций, ошибок блокировки, время, расхождения счетчиков.
+    """
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'stress.sqlite3')
+        with context.Pool(1) as pool:
+            pool.apply(prepare, (db_path, profile))
+        with context.Pool(workers) as pool:
+            # Процессы начинают одновременно, когда все уже настроили Django
+            start_at = time.time() + 3
+            results = pool.starmap(work, [(db_path, profile, seed, iterations, start_at)
+                                          for seed in range(workers)])
+        with context.Pool(1) as pool:
+            mismatches = pool.apply(verify, (db_path, profile))
+    return {'ops': sum(r['ops'] for r in results), 'locked': sum(r['locked'] for r in results),
+            'seconds': max(r['seconds'] for r in results), 'mismatches': mismatches}
@@ -0,0 +1,24 @@
+from django import template
+
+from ..thumbnails import image_url, thumbnail_url
+
+register = template.Library()
+
+
+@register.filter
+def thumb(image, size: str = 'list') -> str:
+    """
+    Адрес уменьшенной копии картинки: {{ advertisement.image|thumb:'list' }}
+    :param image: Поле ImageField.
+    :param size: Размер из settings.THUMBNAIL_SIZES.
+    """
+    return thumbnail_url(image.name, size) if image else ''
+
+
+@register.filter
+def media_url(image) -> str:
+    """
+    Адрес картинки, а пока картинка генерируется - адрес заглушки: {{ img.image|media_url }}
+    :param image: Поле ImageField.
+    """
+    return image_url(image.name) if image else ''
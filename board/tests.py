@@ -1,3 +1,1362 @@
-from django.test import TestCase
+import asyncio
+import base64
+import contextlib
+import gzip
+import os
+import re
+import tempfile
+import threading
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image as PilImage
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import IntegrityError, OperationalError, connection, transaction
+from aiohttp import ClientConnectorError, ClientResponseError, web
+from aiohttp.test_utils import TestServer
+from django.http import HttpResponse
+from django.templatetags.static import static
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Advertisement, Image, Comment, GenerationJob, Like, Preferences, UserStat
+from . import assets, jobs, kandinsky, render_cache, search, stress, thumbnails, utilite
+from .utilite import comments_page, like_set, like_states, retry_locked
+from .pagination import KeysetPaginator, decode_cursor, encode_cursor
+from .storage import ContentAddressedStorage
+
+
+# Проверка незавершенных генераций на первом запросе процесса не должна попадать в подсчет
+# запросов отдельных тестов; сама проверка тестируется в QueueResumeTest
+request_started.disconnect(jobs.resume_queue, dispatch_uid=jobs.RESUME_UID)
+
+
+def clear_caches():
+    for cache in caches.all():
+        cache.clear()
+
+
+class AdvertisementListQueriesTest(TestCase):
+    """  Количество SQL-запросов в списке объявлений не зависит от размера страницы  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.authors = [User.objects.create_user(f'author_{i}', password='pass') for i in range(3)]
+        for i in range(40):
+            author = cls.authors[i % len(cls.authors)]
+            adv = Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=author)
+            for j in range(2):
+                Image.objects.create(advertisement=adv, user=author, image=f'images/user_{author.id}/{i}_{j}.jpg')
+        cls.reader = User.objects.create_user('reader', password='pass')
+
+    def setUp(self):
+        clear_caches()
+
+    def count_queries(self, url: str, cnt: int) -> int:
+        clear_caches()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, {'cnt': cnt})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_anonymous_feed(self):
+        # Версия ленты, COUNT для пагинатора, страница объявлений с авторами, картинки страницы,
+        # версии объявлений для кеша карточек
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('board:advertisement_list'))
+        self.assertContains(response, 'author_0')
+
+    def test_feed_page_size(self):
+        self.client.force_login(self.reader)
+        url = reverse('board:advertisement_list')
+        # Настройки пользователя загружаются в сессию первым запросом
+        self.client.get(url)
+        counts = {cnt: self.count_queries(url, cnt) for cnt in (3, 10, 30)}
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+    def test_author_feed_page_size(self):
+        self.client.force_login(self.reader)
+        url = reverse('board:advertisement_list', kwargs={'pk': self.authors[0].id})
+        # Настройки пользователя загружаются в сессию первым запросом
+        self.client.get(url)
+        counts = {cnt: self.count_queries(url, cnt) for cnt in (3, 10, 30)}
+        self.assertEqual(len(set(counts.values())), 1, counts)
+
+
+class UserStatCountersTest(TestCase):
+    """  Счетчики статистики пользователя меняются инкрементально  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.other = User.objects.create_user('other', password='pass')
+
+    def stat(self, user) -> tuple:
+        return UserStat.objects.filter(user=user).values_list(
+            'advertisement_count', 'comment_count', 'like_count', 'dislike_count').first()
+
+    def test_create_and_delete(self):
+        self.assertIsNone(self.stat(self.author))
+        adv = Advertisement.objects.create(title='Объявление', content='Текст', author=self.author)
+        Comment.objects.create(advertisement=adv, author=self.author, content='Комментарий')
+        like = Like.objects.create(advertisement=adv, user=self.author, like_type=1)
+        Like.objects.create(advertisement=adv, user=self.other, like_type=0)
+        self.assertEqual(self.stat(self.author), (1, 1, 1, 0))
+        self.assertEqual(self.stat(self.other), (0, 0, 0, 1))
+        like.delete()
+        self.assertEqual(self.stat(self.author), (1, 1, 0, 0))
+        adv.delete()
+        self.assertEqual(self.stat(self.author), (0, 0, 0, 0))
+        self.assertEqual(self.stat(self.other), (0, 0, 0, 0))
+
+    def test_edit_skips_stat(self):
+        adv = Advertisement.objects.create(title='Объявление', content='Текст', author=self.author)
+        adv = Advertisement.objects.get(id=adv.id)
+        adv.title = 'Новое название'
+        with CaptureQueriesContext(connection) as ctx:
+            adv.save()
+        self.assertFalse([q for q in ctx.captured_queries if UserStat._meta.db_table in q['sql']])
+        self.assertEqual(self.stat(self.author), (1, 0, 0, 0))
+
+    def test_owner_change(self):
+        adv = Advertisement.objects.create(title='Объявление', content='Текст', author=self.author)
+        like = Like.objects.create(advertisement=adv, user=self.other, like_type=1)
+        like.like_type = 0
+        like.save()
+        adv = Advertisement.objects.get(id=adv.id)
+        adv.author = self.other
+        adv.save()
+        self.assertEqual(self.stat(self.author), (0, 0, 0, 0))
+        self.assertEqual(self.stat(self.other), (1, 0, 0, 1))
+
+
+class LikeToggleTest(TestCase):
+    """  Переключение лайков/дизлайков  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.reader = User.objects.create_user('reader', password='pass')
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.author)
+
+    def setUp(self):
+        self.client.force_login(self.reader)
+
+    def toggle(self, tp: int):
+        self.client.get(reverse('board:like_dislike', kwargs={'pk': self.adv.id, 'tp': tp}),
+                        headers={'Referer': '/board/'})
+
+    def state(self) -> tuple:
+        adv = Advertisement.objects.get(id=self.adv.id)
+        stat = UserStat.objects.filter(user=self.reader).values_list('like_count', 'dislike_count').first()
+        return (adv.like_count, adv.dislike_count, stat,
+                list(Like.objects.filter(user=self.reader).values_list('like_type', flat=True)))
+
+    def test_toggle(self):
+        self.toggle(1)
+        self.assertEqual(self.state(), (1, 0, (1, 0), [1]))
+        self.toggle(0)
+        self.assertEqual(self.state(), (0, 1, (0, 1), [0]))
+        self.toggle(0)
+        self.assertEqual(self.state(), (0, 0, (0, 0), []))
+
+    def test_fixed_queries(self):
+        request = mock.Mock(user=self.reader)
+        counts = []
+        for tp in (1, 0, 0, 1, 0, 0):
+            with CaptureQueriesContext(connection) as ctx:
+                like_set(request, self.adv.id, tp)
+            counts.append(len(ctx.captured_queries))
+            # Сигнал объявления (пересчет статистики автора) не вызывается
+            self.assertFalse([q for q in ctx.captured_queries
+                              if q['sql'].startswith('UPDATE "board_advertisement" SET "title"')])
+        # Первый вызов дополнительно создает счетчик версии пользователя
+        self.assertEqual(counts[4:], counts[1:3], counts)
+        self.assertLessEqual(max(counts), 12, counts)
+
+    def test_like_states(self):
+        other = Advertisement.objects.create(title='Другое', content='Текст', author=self.author)
+        Like.objects.create(advertisement=self.adv, user=self.reader, like_type=1)
+        Like.objects.create(advertisement=other, user=self.reader, like_type=0)
+        Like.objects.create(advertisement=other, user=self.author, like_type=1)
+        with self.assertNumQueries(1):
+            states = like_states(self.reader, [self.adv.id, other.id, other.id + 1])
+        self.assertEqual(states, {self.adv.id: 1, other.id: 0})
+        with self.assertNumQueries(0):
+            self.assertEqual(like_states(AnonymousUser(), [self.adv.id]), {})
+
+    def test_feed_like_state(self):
+        Like.objects.create(advertisement=self.adv, user=self.reader, like_type=1)
+        response = self.client.get(reverse('board:advertisement_list'))
+        self.assertContains(response, 'like_on.png')
+        self.assertNotContains(response, 'dislike_on.png')
+        # Карточка в кеше общая, оценка другого пользователя в нее не попадает
+        self.client.force_login(self.author)
+        self.assertNotContains(self.client.get(reverse('board:advertisement_list')), 'like_on.png')
+
+    def test_duplicate_insert(self):
+        Like.objects.create(advertisement=self.adv, user=self.reader, like_type=1)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Like.objects.create(advertisement=self.adv, user=self.reader, like_type=0)
+
+
+class ReconcileCountersTest(TestCase):
+    """  Команда пересчета денормализованных счетчиков  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user_{i}', password='pass') for i in range(5)]
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=cls.users[i % 2])
+                   for i in range(4)]
+        for i, user in enumerate(cls.users):
+            for adv in cls.ads:
+                Like.objects.create(advertisement=adv, user=user, like_type=(i + adv.id) % 2)
+            Comment.objects.create(advertisement=cls.ads[0], author=user, content='Комментарий')
+
+    def snapshot(self) -> tuple:
+        return (list(Advertisement.objects.order_by('id').values_list('like_count', 'dislike_count')),
+                list(UserStat.objects.order_by('user_id').values_list('user_id', 'advertisement_count',
+                                                                       'comment_count', 'like_count',
+                                                                       'dislike_count')))
+
+    def test_reconcile(self):
+        # Like.objects.create не меняет счетчики объявлений (это делает like_set) - выставляем их
+        for adv in self.ads:
+            Advertisement.objects.filter(id=adv.id).update(
+                like_count=adv.likes.filter(like_type=1).count(), dislike_count=adv.likes.filter(like_type=0).count())
+        expected = self.snapshot()
+        # Расхождения: счетчики объявления, статистика пользователя, удаленная строка статистики
+        Advertisement.objects.filter(id=self.ads[1].id).update(like_count=100, dislike_count=-3)
+        UserStat.objects.filter(user=self.users[2]).update(like_count=0, comment_count=7)
+        UserStat.objects.filter(user=self.users[3]).delete()
+        broken = self.snapshot()
+
+        out = StringIO()
+        call_command('reconcile_counters', '--dry-run', '--chunk-size=2', stdout=out)
+        self.assertEqual(self.snapshot(), broken)
+        self.assertIn('Найдено расхождений: объявлений 1, пользователей 2', out.getvalue())
+        self.assertIn('like_count 100 -> ', out.getvalue())
+
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('reconcile_counters', '--chunk-size=2', stdout=StringIO())
+        self.assertEqual(self.snapshot(), expected)
+        # Частями по 2 строки: запросы на часть, а не на строку
+        self.assertLess(len(ctx.captured_queries), 40)
+
+        out = StringIO()
+        call_command('reconcile_counters', stdout=out)
+        self.assertIn('Исправлено: объявлений 0, пользователей 0', out.getvalue())
+
+
+@override_settings(STAT_PAGE_SIZE=4)
+class UserStatListTest(TestCase):
+    """  Страница статистики: сортировка, курсоры, место пользователя  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user_{i}', password='pass') for i in range(10)]
+        # like_count: 0, 0, 1, 1, 2, 2, ... - одинаковые значения упорядочиваются по id
+        UserStat.objects.bulk_create([UserStat(user=user, like_count=i // 2, comment_count=i)
+                                      for i, user in enumerate(cls.users)])
+
+    def setUp(self):
+        clear_caches()
+
+    def names(self, response) -> list[str]:
+        return [stat.user.username for stat in response.context['user_stat']]
+
+    def test_sort_and_pages(self):
+        url = reverse('board:user_stat_list')
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'sort': 'like_count'})
+        self.assertEqual(self.names(response), ['user_9', 'user_8', 'user_7', 'user_6'])
+        page = response.context['user_stat']
+        response = self.client.get(url, {'sort': 'like_count', 'after': page.next_cursor()})
+        self.assertEqual(self.names(response), ['user_5', 'user_4', 'user_3', 'user_2'])
+        page = response.context['user_stat']
+        response = self.client.get(url, {'sort': 'like_count', 'before': page.previous_cursor()})
+        self.assertEqual(self.names(response), ['user_9', 'user_8', 'user_7', 'user_6'])
+        # Неизвестная сортировка - сортировка по умолчанию
+        self.assertEqual(self.client.get(url, {'sort': 'user__password'}).context['sort'], 'advertisement_count')
+
+    def test_my_rank(self):
+        self.client.force_login(self.users[4])
+        url = reverse('board:user_stat_list')
+        response = self.client.get(url, {'sort': 'comment_count'})
+        self.assertEqual(response.context['my_rank'], 6)
+        response = self.client.get(url, {'sort': 'comment_count', 'after': response.context['my_cursor']})
+        self.assertEqual(self.names(response), ['user_4', 'user_3', 'user_2', 'user_1'])
+
+
+class PreferencesCacheTest(TestCase):
+    """  Настройки пользователя читаются один раз и не перезаписываются без изменений  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('reader', password='pass')
+
+    def setUp(self):
+        clear_caches()
+        self.client.force_login(self.user)
+        self.url = reverse('board:advertisement_list')
+
+    def preference_queries(self, params=None) -> list[str]:
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url, params or {})
+        return [q['sql'] for q in ctx.captured_queries if Preferences._meta.db_table in q['sql']]
+
+    def test_loaded_once(self):
+        self.assertTrue(self.preference_queries())
+        self.assertEqual(self.preference_queries(), [])
+        with override_settings(PREFERENCES_TTL=-1):
+            self.assertTrue(self.preference_queries())
+
+    def test_page_count_write_skipped(self):
+        self.preference_queries()
+        self.assertEqual(self.preference_queries({'cnt': 5}), [])
+        updates = self.preference_queries({'cnt': 10})
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(updates[0].startswith('UPDATE'))
+        self.assertEqual(Preferences.objects.get(user=self.user).page_num, 10)
+        self.assertEqual(self.preference_queries({'cnt': 10}), [])
+        self.assertEqual(len(self.client.get(self.url).context['advertisements_feeds']), 0)
+
+    def test_theme_toggle(self):
+        self.client.get(self.url, {'day': 'theme'})
+        self.assertEqual(Preferences.objects.get(user=self.user).theme, 'dark')
+        self.assertEqual(self.client.get(self.url).context['user_pref']['theme'], 'dark')
+        self.client.get(self.url, {'day': 'theme'})
+        self.assertEqual(Preferences.objects.get(user=self.user).theme, 'light')
+
+    def test_settings_form(self):
+        self.preference_queries()
+        self.client.post(reverse('board:user_settings'), {'theme': 'dark', 'page_num': 30})
+        self.assertEqual(self.client.get(self.url).context['user_pref']['page_num'], 30)
+
+
+class SearchTest(TestCase):
+    """  Полнотекстовый поиск по объявлениям и комментариям  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.bike = Advertisement.objects.create(title='Продам велосипед', content='Горный, почти новый',
+                                                author=cls.author)
+        cls.sofa = Advertisement.objects.create(title='Диван', content='Отдам диван, велосипед не нужен',
+                                                author=cls.author)
+        cls.comment = Comment.objects.create(advertisement=cls.sofa, author=cls.author,
+                                             content='Есть ли <b>доставка</b>?')
+
+    def test_ranked_and_highlighted(self):
+        results = search.search('велосипед')
+        self.assertEqual([r.object_id for r in results], [self.bike.id, self.sofa.id])
+        self.assertIn('<mark>велосипед</mark>', results[0].title)
+        self.assertIn('<mark>велосипед</mark>', results[1].snippet)
+        # Поиск по префиксу, без учета регистра; операторы FTS5 не интерпретируются
+        self.assertEqual(len(search.search('ВЕЛОС')), 2)
+        self.assertEqual(search.search('" OR NEAR('), [])
+
+    def test_comment_escaped(self):
+        response = self.client.get(reverse('board:search'), {'q': 'доставка'})
+        result, = response.context['results']
+        self.assertEqual((result.kind, result.advertisement_id), (search.COMMENT, self.sofa.id))
+        self.assertContains(response, '&lt;b&gt;<mark>доставка</mark>&lt;/b&gt;')
+        self.assertContains(response, 'Диван')
+
+    def test_signal_sync(self):
+        self.bike.title = 'Продам самокат'
+        self.bike.save()
+        self.assertEqual([r.object_id for r in search.search('самокат')], [self.bike.id])
+        self.comment.delete()
+        self.assertEqual(search.search('доставка'), [])
+        self.sofa.delete()
+        self.assertEqual(search.search('диван'), [])
+
+    def test_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.TABLE}')
+        self.assertEqual(search.search('велосипед'), [])
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Проиндексировано записей: 3', out.getvalue())
+        self.assertEqual(len(search.search('велосипед')), 2)
+
+
+class QueryPlanTest(TestCase):
+    """  Запросы представлений используют индексы, а не полный просмотр таблиц  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.reader = User.objects.create_user('reader', password='pass')
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=cls.author)
+                   for i in range(3)]
+        for adv in cls.ads:
+            Image.objects.create(advertisement=adv, user=cls.author, image='images/a.jpg')
+            Comment.objects.create(advertisement=adv, author=cls.reader, content='Комментарий')
+            Like.objects.create(advertisement=adv, user=cls.reader, like_type=1)
+
+    def setUp(self):
+        clear_caches()
+
+    def full_scans(self, *requests) -> list[str]:
+        """
+        Выполнить запросы к представлениям и вернуть планы запросов с полным просмотром таблиц доски
+        :param requests: Пары (метод клиента, url, параметры).
+        """
+        with CaptureQueriesContext(connection) as ctx:
+            for method, url, params in requests:
+                method(url, params)
+        scans = []
+        for query in ctx.captured_queries:
+            sql = query['sql']
+            if not sql.startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                plan = [row[-1] for row in cursor.fetchall()]
+            # Просмотр таблицы по первичному ключу с LIMIT без условий (первая страница ленты) читает
+            # только нужные строки - разрешен только этот шаг, просмотр с фильтром считается полным.
+            # Результаты полнотекстового поиска сортируются по релевантности после отбора по индексу
+            by_key = re.search(r'ORDER BY "(board_\w+)"\."id"(?: DESC)? LIMIT', sql)
+            key_scan = f'SCAN {by_key.group(1)}' if by_key and ' WHERE ' not in sql else None
+            ranked = ' MATCH ' in sql
+            scans += [f'{step} <- {sql}' for step in plan
+                      if step.startswith('SCAN board_') and ' INDEX' not in step and step != key_scan
+                      or step.startswith('USE TEMP B-TREE') and not ranked]
+        return scans
+
+    def test_anonymous_views(self):
+        adv = self.ads[0]
+        self.assertEqual(self.full_scans(
+            (self.client.get, reverse('board:advertisement_list'), {}),
+            (self.client.get, reverse('board:advertisement_list', kwargs={'pk': self.author.id}), {}),
+            (self.client.get, reverse('board:advertisement_detail', kwargs={'pk': adv.id}), {}),
+            (self.client.get, reverse('board:board_changes'), {'key': f'adv:{adv.id}', 'v': 1}),
+            (self.client.get, reverse('board:search'), {'q': 'Объявление'}),
+            (self.client.get, reverse('board:user_stat_list'), {'sort': 'like_count'}),
+        ), [])
+
+    def test_user_views(self):
+        self.client.force_login(self.reader)
+        adv = self.ads[1]
+        self.assertEqual(self.full_scans(
+            (self.client.get, reverse('board:advertisement_list'), {}),
+            (self.client.get, reverse('board:advertisement_list', kwargs={'pk': self.author.id}), {'cnt': 10}),
+            (self.client.get, reverse('board:advertisement_detail', kwargs={'pk': adv.id}), {}),
+            (self.client.get, reverse('board:like_dislike', kwargs={'pk': adv.id, 'tp': 0}), {}),
+            (self.client.get, reverse('board:like_dislike', kwargs={'pk': adv.id, 'tp': 0}), {}),
+            (self.client.get, reverse('board:user_stat_list'), {'sort': 'comment_count'}),
+        ), [])
+
+
+class SQLiteConcurrencyTest(SimpleTestCase):
+    """  Несколько процессов пишут в одну базу SQLite без ошибок блокировки  """
+
+    def test_concurrent_profile(self):
+        result = stress.run('concurrent', workers=4, iterations=100)
+        self.assertEqual(result['locked'], 0)
+        self.assertEqual(result['ops'], 400)
+        self.assertEqual(result['mismatches'], [])
+
+    def test_retry_locked(self):
+        calls = []
+
+        @retry_locked
+        def write():
+            calls.append(1)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'ok'
+
+        with override_settings(DB_LOCK_RETRIES=5, DB_LOCK_RETRY_DELAY=0):
+            self.assertEqual(write(), 'ok')
+        self.assertEqual(len(calls), 3)
+        with override_settings(DB_LOCK_RETRIES=1, DB_LOCK_RETRY_DELAY=0), self.assertRaises(OperationalError):
+            calls.clear()
+            write()
+
+
+class LikeRetryTest(TransactionTestCase):
+    """  Переключение оценки повторяется целиком, если SQLite ответила "database is locked"  """
+
+    def test_like_set_retried(self):
+        author = User.objects.create_user('author', password='pass')
+        reader = User.objects.create_user('reader', password='pass')
+        adv = Advertisement.objects.create(title='Объявление', content='Текст', author=author)
+        change_user_stat = utilite.change_user_stat
+        calls = []
+
+        def locked_once(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return change_user_stat(*args, **kwargs)
+
+        with override_settings(DB_LOCK_RETRY_DELAY=0), \
+                mock.patch('board.utilite.change_user_stat', side_effect=locked_once):
+            like_set(mock.Mock(user=reader), adv.id, 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(Advertisement.objects.get(id=adv.id).like_count, 1)
+        self.assertEqual(Like.objects.filter(user=reader).count(), 1)
+
+
+@override_settings(COMMENTS_PAGE_SIZE=4)
+class CommentsPageTest(TestCase):
+    """  Комментарии объявления загружаются страницами  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user_{i}', password='pass') for i in range(3)]
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.users[0])
+        cls.comments = [Comment.objects.create(advertisement=cls.adv, author=cls.users[i % 3],
+                                               content=f'Комментарий {i}')
+                        for i in range(10)]
+        # Одинаковое время создания - порядок определяет id
+        Comment.objects.filter(id__in=[c.id for c in cls.comments[3:6]]).update(
+            created_at=cls.comments[3].created_at)
+
+    def setUp(self):
+        clear_caches()
+
+    def test_detail_first_page(self):
+        response = self.client.get(reverse('board:advertisement_detail', kwargs={'pk': self.adv.id}))
+        self.assertEqual([c.id for c in response.context['comments']], [c.id for c in self.comments[:4]])
+        self.assertContains(response, 'Показать еще')
+
+    def test_load_more(self):
+        url = reverse('board:advertisement_comments', kwargs={'pk': self.adv.id})
+        _, cursor = comments_page(self.adv.id)
+        seen = [c.id for c in self.comments[:4]]
+        while cursor:
+            # Один запрос: комментарии с авторами (версия объявления для ETag - еще один)
+            with self.assertNumQueries(2):
+                response = self.client.get(url, {'after': cursor})
+            seen += [c.id for c in response.context['comments']]
+            cursor = response.headers.get('X-Next-Cursor')
+        self.assertEqual(seen, [c.id for c in self.comments])
+
+    def test_json(self):
+        self.client.force_login(self.users[1])
+        _, cursor = comments_page(self.adv.id, per_page=8)
+        data = self.client.get(reverse('board:advertisement_comments', kwargs={'pk': self.adv.id}),
+                               {'after': cursor, 'format': 'json'}).json()
+        self.assertIsNone(data['next'])
+        self.assertEqual([(c['content'], c['author'], c['editable']) for c in data['comments']],
+                         [('Комментарий 8', 'user_2', False), ('Комментарий 9', 'user_0', False)])
+
+
+class ApiTest(TestCase):
+    """  JSON API только для чтения: выбор полей, курсоры, ETag и сжатие  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create_user(f'user_{i}', password='pass') for i in range(3)]
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст ' * 20,
+                                                author=cls.users[i % 2])
+                   for i in range(7)]
+        cls.comments = [Comment.objects.create(advertisement=cls.ads[0], author=cls.users[2],
+                                               content=f'Комментарий {i}')
+                        for i in range(5)]
+
+    def setUp(self):
+        clear_caches()
+
+    def walk(self, url: str, params: dict) -> list[dict]:
+        results, cursor = [], None
+        while True:
+            data = self.client.get(url, {**params, **({'after': cursor} if cursor else {})}).json()
+            results += data['results']
+            cursor = data['next']
+            if not cursor:
+                return results
+
+    def test_feed_fields(self):
+        url = reverse('board:api_feed')
+        with CaptureQueriesContext(connection) as queries:
+            data = self.client.get(url, {'fields': 'title,author', 'limit': 3}).json()
+        self.assertEqual(data['results'][0], {'title': 'Объявление 6', 'author': 'user_0'})
+        select = [q['sql'] for q in queries if 'board_advertisement' in q['sql']][0]
+        self.assertNotIn('"content"', select)
+        self.assertNotIn('"like_count"', select)
+        self.assertEqual([row['title'] for row in self.walk(url, {'fields': 'title', 'limit': 3})],
+                         [f'Объявление {i}' for i in range(6, -1, -1)])
+
+    def test_feed_author(self):
+        rows = self.walk(reverse('board:api_feed'), {'author': self.users[1].id, 'fields': 'id,author_id'})
+        self.assertEqual(rows, [{'id': adv.id, 'author_id': self.users[1].id} for adv in self.ads[::-1]
+                                if adv.author_id == self.users[1].id])
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse('board:api_feed'), {'fields': 'title,password'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'unknown fields: password'})
+
+    def test_advertisement(self):
+        Image.objects.create(advertisement=self.ads[0], user=self.users[0], image='images/a.jpg')
+        url = reverse('board:api_advertisement', kwargs={'pk': self.ads[0].id})
+        data = self.client.get(url, {'fields': 'title,images'}).json()
+        self.assertEqual(data, {'title': 'Объявление 0', 'images': ['/media/images/a.jpg']})
+        self.assertEqual(self.client.get(reverse('board:api_advertisement', kwargs={'pk': 999})).status_code, 404)
+
+    def test_comments(self):
+        url = reverse('board:api_comments', kwargs={'pk': self.ads[0].id})
+        rows = self.walk(url, {'fields': 'content', 'limit': 2})
+        self.assertEqual(rows, [{'content': f'Комментарий {i}'} for i in range(5)])
+        self.assertEqual(self.client.get(reverse('board:api_comments', kwargs={'pk': 999})).status_code, 404)
+
+    def test_stats(self):
+        data = self.client.get(reverse('board:api_stats'),
+                               {'sort': 'comment_count', 'fields': 'username,comment_count'}).json()
+        self.assertEqual(data['results'][0], {'username': 'user_2', 'comment_count': 5})
+        self.assertEqual(self.client.get(reverse('board:api_stats'), {'sort': 'id'}).status_code, 400)
+
+    def test_etag_and_gzip(self):
+        url = reverse('board:api_feed')
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etag,
+                                                           'Accept-Encoding': 'gzip'}).status_code, 304)
+        Advertisement.objects.create(title='Новое', content='Текст', author=self.users[0])
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+        self.assertEqual(self.client.post(url).status_code, 405)
+
+
+class KeysetPaginationTest(TestCase):
+    """  Пагинация ленты по курсорам  """
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user('author', password='pass')
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=author)
+                   for i in range(12)]
+
+    def setUp(self):
+        clear_caches()
+
+    def test_cursor_roundtrip(self):
+        self.assertEqual(decode_cursor(encode_cursor(12345)), 12345)
+        self.assertIsNone(decode_cursor('не курсор'))
+        self.assertIsNone(decode_cursor(None))
+
+    def test_walk_forward_and_back(self):
+        paginator = KeysetPaginator(Advertisement.objects.all(), 5, count_key='all')
+        first = paginator.get_page()
+        self.assertEqual([a.id for a in first], [a.id for a in self.ads[::-1][:5]])
+        self.assertFalse(first.has_previous())
+        second = paginator.get_page(after=first.next_cursor())
+        self.assertEqual([a.id for a in second], [a.id for a in self.ads[::-1][5:10]])
+        third = paginator.get_page(after=second.next_cursor())
+        self.assertEqual(len(third), 2)
+        self.assertFalse(third.has_next())
+        back = paginator.get_page(before=third.previous_cursor())
+        self.assertEqual([a.id for a in back], [a.id for a in second])
+        self.assertTrue(back.has_previous())
+        self.assertEqual([a.id for a in paginator.get_page(before=back.previous_cursor())],
+                         [a.id for a in first])
+
+    def test_count_is_cached(self):
+        paginator = KeysetPaginator(Advertisement.objects.all(), 5, count_key='all')
+        self.assertEqual(paginator.count, 12)
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 12)
+
+    def test_deep_page_costs_like_first(self):
+        url = reverse('board:advertisement_list')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as first:
+            caches['render'].clear()
+            self.client.get(url)
+        with CaptureQueriesContext(connection) as deep:
+            caches['render'].clear()
+            response = self.client.get(url, {'after': encode_cursor(self.ads[3].id)})
+        self.assertEqual(len(first), len(deep))
+        self.assertContains(response, 'Объявление 2')
+        self.assertNotContains(response, 'Объявление 3<')
+
+    @override_settings(FEED_PAGINATION='page')
+    def test_page_mode(self):
+        response = self.client.get(reverse('board:advertisement_list'), {'page': 3})
+        self.assertContains(response, 'Объявление 1<')
+
+
+class RenderCacheTest(TestCase):
+    """  Кеш отрисованных страниц ленты и карточек объявлений  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=cls.author)
+                   for i in range(3)]
+
+    def setUp(self):
+        clear_caches()
+
+    def test_anonymous_page_hit(self):
+        url = reverse('board:advertisement_list')
+        html = self.client.get(url).content
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.content, html)
+        self.assertEqual(render_cache.stats()['page_hit'], 1)
+
+    def test_image_invalidates_only_its_card(self):
+        url = reverse('board:advertisement_list')
+        self.client.get(url)
+        Image.objects.create(advertisement=self.ads[0], user=self.author, image='images/new.jpg')
+        response = self.client.get(url)
+        # Файла картинки нет, поэтому в новой карточке показывается заглушка
+        self.assertContains(response, 'gen.jpg')
+        self.assertEqual(render_cache.stats(),
+                         {'page_hit': 0, 'page_miss': 2, 'card_hit': 2, 'card_miss': 4})
+
+    def test_authenticated_not_page_cached(self):
+        self.client.force_login(self.author)
+        url = reverse('board:advertisement_list')
+        self.client.get(url)
+        self.assertContains(self.client.get(url), 'Выход')
+        self.assertEqual(render_cache.stats()['page_hit'], 0)
+
+
+class BoardChangesTest(TestCase):
+    """  Проверка изменений на доске для автообновления страниц  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.author)
+
+    def changes(self, version) -> dict:
+        return self.client.get(reverse('board:board_changes'), {'v': version}).json()
+
+    def test_unchanged(self):
+        version = self.changes(0)['version']
+        self.assertFalse(self.changes(version)['changed'])
+
+    def test_new_comment_changes_version(self):
+        version = self.changes(0)['version']
+        Comment.objects.create(advertisement=self.adv, author=self.author, content='Комментарий')
+        data = self.changes(version)
+        self.assertTrue(data['changed'])
+        self.assertGreater(data['version'], version)
+
+    def test_page_embeds_version(self):
+        version = self.client.get(reverse('board:board_changes'), {'key': 'feed'}).json()['version']
+        response = self.client.get(reverse('board:advertisement_list'))
+        self.assertContains(response, f'data-key="feed" data-version="{version}"')
+
+    def test_unknown_key(self):
+        response = self.client.get(reverse('board:board_changes'), {'key': 'user:1'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ConditionalGetTest(TestCase):
+    """  Ответ 304 для ленты и деталей объявления, если данные не менялись  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.other = User.objects.create_user('other', password='pass')
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.author)
+        cls.other_adv = Advertisement.objects.create(title='Другое', content='Текст', author=cls.other)
+
+    def assert_not_modified(self, url: str, headers: dict):
+        with self.assertNumQueries(1):
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_feed_etag(self):
+        url = reverse('board:advertisement_list')
+        etag = self.client.get(url)['ETag']
+        self.assert_not_modified(url, {'If-None-Match': etag})
+        Advertisement.objects.create(title='Новое', content='Текст', author=self.author)
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_feed_last_modified(self):
+        url = reverse('board:advertisement_list')
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assert_not_modified(url, {'If-Modified-Since': last_modified})
+
+    def test_author_feed_ignores_other_authors(self):
+        url = reverse('board:advertisement_list', kwargs={'pk': self.author.id})
+        etag = self.client.get(url)['ETag']
+        Advertisement.objects.create(title='Новое', content='Текст', author=self.other)
+        self.assert_not_modified(url, {'If-None-Match': etag})
+
+    def test_detail_changes_with_comments(self):
+        url = reverse('board:advertisement_detail', kwargs={'pk': self.adv.id})
+        etag = self.client.get(url)['ETag']
+        self.assert_not_modified(url, {'If-None-Match': etag})
+        Comment.objects.create(advertisement=self.other_adv, author=self.other, content='Комментарий')
+        self.assert_not_modified(url, {'If-None-Match': etag})
+        Comment.objects.create(advertisement=self.adv, author=self.other, content='Комментарий')
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_feeds_change_with_likes(self):
+        urls = [reverse('board:advertisement_list'), reverse('board:advertisement_list', kwargs={'pk': self.author.id}),
+                reverse('board:api_feed')]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        like_set(mock.Mock(user=self.other), self.adv.id, 1)
+        for url, etag in zip(urls, etags):
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        Like.objects.filter(advertisement=self.adv).delete()
+        for url, etag in zip(urls, etags):
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_etag_depends_on_user(self):
+        url = reverse('board:advertisement_detail', kwargs={'pk': self.adv.id})
+        etag = self.client.get(url)['ETag']
+        self.client.force_login(self.author)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+
+
+class ThumbnailTest(TestCase):
+    """  Уменьшенные копии картинок для списка и деталей объявления  """
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name, THUMBNAIL_WORKERS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        os.makedirs(os.path.join(self.media.name, 'images'))
+        PilImage.new('RGB', (1024, 1024), 'red').save(os.path.join(self.media.name, 'images', 'big.jpg'))
+
+    def test_generate(self):
+        thumbnails.generate('images/big.jpg')
+        with PilImage.open(os.path.join(self.media.name, thumbnails.thumb_name('images/big.jpg', 'list'))) as img:
+            self.assertEqual(img.size, (60, 60))
+        self.assertEqual(thumbnails.generate('images/big.jpg'), [])
+
+    def test_same_stem_different_extension(self):
+        PilImage.new('RGB', (100, 100), 'blue').save(os.path.join(self.media.name, 'images', 'big.png'))
+        self.assertNotEqual(thumbnails.thumb_name('images/big.jpg', 'list'),
+                            thumbnails.thumb_name('images/big.png', 'list'))
+        thumbnails.generate('images/big.jpg')
+        self.assertFalse(thumbnails.is_fresh('images/big.png', 'list'))
+
+    def test_on_demand(self):
+        url = thumbnails.thumbnail_url('images/big.jpg', 'list')
+        self.assertEqual(url, reverse('board:thumbnail', kwargs={'size': 'list', 'name': 'images/big.jpg'}))
+        response = self.client.get(url)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with PilImage.open(BytesIO(b''.join(response.streaming_content))) as img:
+            self.assertEqual(img.size, (60, 60))
+        self.assertTrue(thumbnails.is_fresh('images/big.jpg', 'list'))
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+    def test_placeholder_not_cached(self):
+        PilImage.new('RGB', (100, 100), 'gray').save(os.path.join(self.media.name, thumbnails.PLACEHOLDER))
+        response = self.client.get(thumbnails.thumbnail_url('images/generating.jpg', 'list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        response.close()
+
+    def test_on_demand_rejects_outside_media(self):
+        response = self.client.get(reverse('board:thumbnail', kwargs={'size': 'list', 'name': '../etc/passwd'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class UploadImagesTest(TestCase):
+    """  Загрузка нескольких картинок: проверка при получении данных и один INSERT  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.author)
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name, THUMBNAIL_WORKERS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client.force_login(self.author)
+        self.url = reverse('board:add_image', kwargs={'pk': self.adv.id})
+
+    @staticmethod
+    def png(name: str) -> SimpleUploadedFile:
+        data = BytesIO()
+        PilImage.new('RGB', (40, 40), 'blue').save(data, 'PNG')
+        return SimpleUploadedFile(name, data.getvalue(), 'image/png')
+
+    def test_bulk_upload(self):
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.url, {'photo': [self.png('a.png'), self.png('b.png')]})
+        self.assertRedirects(response, reverse('board:edit_advertisement', kwargs={'pk': self.adv.id}),
+                             fetch_redirect_response=False)
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('INSERT INTO "board_image"')]), 1)
+        names = list(Image.objects.filter(advertisement=self.adv).values_list('image', flat=True))
+        self.assertEqual(len(names), 2)
+        for name in names:
+            self.assertTrue(name.startswith(f'images/user_{self.author.id}/'))
+            self.assertTrue(os.path.exists(os.path.join(self.media.name, name)))
+            self.assertTrue(thumbnails.is_fresh(name, 'list'))
+
+    def test_not_an_image(self):
+        text = SimpleUploadedFile('image.png', 'не картинка'.encode(), 'image/png')
+        response = self.client.post(self.url, {'photo': [self.png('a.png'), text]})
+        self.assertContains(response, 'image.png: файл не является картинкой')
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=100)
+    def test_too_large(self):
+        response = self.client.post(self.url, {'photo': [self.png('a.png')]})
+        self.assertContains(response, 'a.png: файл больше')
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(IMAGE_UPLOAD_MAX_FILES=1)
+    def test_too_many(self):
+        response = self.client.post(self.url, {'photo': [self.png('a.png'), self.png('b.png')]})
+        self.assertContains(response, 'не больше 1 файлов')
+        self.assertFalse(Image.objects.exists())
+
+    @override_settings(STORAGES={'default': {'BACKEND': 'board.storage.ContentAddressedStorage'},
+                                 'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'}})
+    def test_duplicates_share_file(self):
+        self.client.post(self.url, {'photo': [self.png('a.png'), self.png('b.png')]})
+        first, second = Image.objects.filter(advertisement=self.adv).order_by('id')
+        self.assertTrue(os.path.samefile(first.image.path, second.image.path))
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(os.path.exists(first.image.path))
+        self.assertEqual(first.image.storage.references(second.image.name), 1)
+
+    def test_filesystem_storage_keeps_files(self):
+        self.client.post(self.url, {'photo': [self.png('a.png')]})
+        image = Image.objects.get(advertisement=self.adv)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            image.delete()
+        self.assertEqual(callbacks, [])
+        self.assertTrue(os.path.exists(image.image.path))
+
+    def test_csrf(self):
+        client = self.client_class(enforce_csrf_checks=True)
+        client.force_login(self.author)
+        self.assertEqual(client.post(self.url, {'photo': [self.png('a.png')]}).status_code, 403)
+
+
+class ContentAddressedStorageTest(SimpleTestCase):
+    """  Одинаковые файлы хранятся один раз, blob удаляется с последней ссылкой  """
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.storage = ContentAddressedStorage(location=self.media.name)
+
+    def blobs(self) -> list[str]:
+        return [name for root, _, files in os.walk(os.path.join(self.media.name, 'blobs'))
+                if os.path.basename(root) != 'tmp' for name in files if name != '.lock']
+
+    def test_deduplicate(self):
+        first = self.storage.save('images/user_1/a.jpg', ContentFile(b'picture'))
+        second = self.storage.save('images/user_2/a.jpg', ContentFile(b'picture'))
+        same_name = self.storage.save('images/user_1/a.jpg', ContentFile(b'picture'))
+        other = self.storage.save('images/user_1/b.jpg', ContentFile(b'other picture'))
+        self.assertNotEqual(first, same_name)
+        self.assertEqual(len(self.blobs()), 2)
+        self.assertEqual(self.storage.references(first), 3)
+        self.assertTrue(os.path.samefile(self.storage.path(first), self.storage.path(second)))
+        with self.storage.open(other) as file:
+            self.assertEqual(file.read(), b'other picture')
+
+    def test_delete(self):
+        first = self.storage.save('a.jpg', ContentFile(b'picture'))
+        second = self.storage.save('b.jpg', ContentFile(b'picture'))
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        self.assertEqual(len(self.blobs()), 1)
+        self.assertEqual(self.storage.references(second), 1)
+        self.storage.delete(second)
+        self.assertEqual(self.blobs(), [])
+
+    def test_delete_waits_for_link(self):
+        first = self.storage.save('a.jpg', ContentFile(b'picture'))
+        blob = self.storage.path(self.storage.blob_name(self.storage.digest(first)))
+        with self.storage._locked():
+            # Пока другой запрос создает ссылку на blob, удаление последней ссылки ждет
+            deleting = threading.Thread(target=self.storage.delete, args=[first])
+            deleting.start()
+            deleting.join(0.2)
+            self.assertTrue(deleting.is_alive())
+            os.link(blob, self.storage.path('b.jpg'))
+        deleting.join()
+        self.assertFalse(self.storage.exists(first))
+        with self.storage.open('b.jpg') as file:
+            self.assertEqual(file.read(), b'picture')
+        self.assertEqual(len(self.blobs()), 1)
+
+    def test_collect_garbage(self):
+        name = self.storage.save('a.jpg', ContentFile(b'picture'))
+        os.remove(self.storage.path(name))
+        self.assertEqual(self.storage.collect_garbage(), 1)
+        self.assertEqual(self.blobs(), [])
+
+
+class StaticAssetsTest(SimpleTestCase):
+    """  Статические файлы: имена с хешем, сжатые варианты и отдача по индексу в памяти  """
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+        override = override_settings(STATIC_ROOT=self.root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.middleware = assets.StaticFilesMiddleware(lambda request: HttpResponse(status=404))
+
+    def get(self, url: str, **headers):
+        return self.middleware(RequestFactory().get(url, headers=headers))
+
+    def test_hashed_and_compressed(self):
+        url = static('board_project/style-day.css')
+        self.assertRegex(url, r'^/static/board_project/style-day\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(self.root.name, url[len('/static/'):] + '.gz')))
+        with open(os.path.join(self.root.name, 'board_project', 'style-day.css'), 'rb') as file:
+            original = file.read()
+        response = self.get(url, **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Cache-Control'], assets.IMMUTABLE)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        body = gzip.decompress(b''.join(response.streaming_content))
+        # Ссылки на картинки в CSS заменены именами с хешем
+        self.assertIn(b'day_fon.', body)
+        self.assertNotEqual(body, original)
+
+    def test_conditional_and_plain(self):
+        url = static('board_project/style-day.css')
+        response = self.get(url)
+        self.assertNotIn('Content-Encoding', response)
+        response.close()
+        self.assertEqual(self.get(url, **{'If-None-Match': response['ETag']}).status_code, 304)
+        response = self.get('/static/board_project/style-day.css')
+        self.assertTrue(response['Cache-Control'].startswith('public, max-age='))
+        response.close()
+
+    def test_unknown_file(self):
+        self.assertEqual(self.get('/static/../manage.py').status_code, 404)
+        self.assertEqual(self.get('/static/missing.css').status_code, 404)
+
+
+class MediaServeTest(SimpleTestCase):
+    """  Медиафайлы: Range, условные запросы и передача отдачи фронтовому серверу  """
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        os.makedirs(os.path.join(self.media.name, 'images'))
+        self.data = bytes(range(256)) * 40
+        with open(os.path.join(self.media.name, 'images', 'a.jpg'), 'wb') as file:
+            file.write(self.data)
+        self.url = '/media/images/a.jpg'
+
+    def test_full(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['Cache-Control'].startswith('public, max-age='))
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': response['ETag']}).status_code, 304)
+        self.assertEqual(self.client.get(self.url, headers={'If-Modified-Since': response['Last-Modified']})
+                         .status_code, 304)
+
+    def test_range(self):
+        for header, start, end in (('bytes=100-199', 100, 199), ('bytes=10000-', 10000, 10239),
+                                   ('bytes=-40', 10200, 10239), ('bytes=10200-99999', 10200, 10239)):
+            response = self.client.get(self.url, headers={'Range': header})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{len(self.data)}')
+            self.assertEqual(int(response['Content-Length']), end - start + 1)
+            self.assertEqual(b''.join(response.streaming_content), self.data[start:end + 1])
+        response = self.client.get(self.url, headers={'Range': 'bytes=99999-'})
+        self.assertEqual(response.status_code, 416)
+        # Файл изменился (If-Range не совпадает) - отдается целиком
+        response = self.client.get(self.url, headers={'Range': 'bytes=0-9', 'If-Range': '"old"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_not_found(self):
+        self.assertEqual(self.client.get('/media/images/missing.jpg').status_code, 404)
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/images/').status_code, 404)
+
+    @override_settings(MEDIA_SERVE='x-accel')
+    def test_x_accel(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/images/a.jpg')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(MEDIA_SERVE='x-sendfile')
+    def test_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(self.media.name, 'images', 'a.jpg'))
+
+
+class GenerationQueueTest(TestCase):
+    """  Очередь генерации картинок Kandinsky  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.ads = [Advertisement.objects.create(title=f'Объявление {i}', content='Текст', author=cls.author)
+                   for i in range(3)]
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        override = override_settings(MEDIA_ROOT=self.media.name, KANDINSKY_WORKER='command',
+                                     KANDINSKY_CONCURRENCY=2, THUMBNAIL_WORKERS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_repeated_clicks_deduplicated(self):
+        self.client.force_login(self.author)
+        url = reverse('board:image_generation', kwargs={'pk': self.ads[0].id})
+        for _ in range(5):
+            self.client.post(url, headers={'Referer': '/board/'})
+        self.assertEqual(GenerationJob.objects.count(), 1)
+        self.assertEqual(Image.objects.filter(advertisement=self.ads[0]).count(), 1)
+        job = GenerationJob.objects.get()
+        self.assertEqual(job.state, GenerationJob.QUEUED)
+        # Заглушка не копируется: до окончания генерации показывается общий файл
+        self.assertFalse(os.path.exists(os.path.join(self.media.name, job.image.image.name)))
+        self.assertEqual(thumbnails.image_url(job.image.image.name), '/media/gen.jpg')
+
+    def test_concurrency_cap(self):
+        for adv in self.ads:
+            jobs.enqueue(adv, self.author)
+        self.assertIsNotNone(jobs.claim_next())
+        self.assertIsNotNone(jobs.claim_next())
+        self.assertIsNone(jobs.claim_next())
+        self.assertEqual(GenerationJob.objects.filter(state=GenerationJob.QUEUED).count(), 1)
+
+    def test_run_job(self):
+        jobs.enqueue(self.ads[0], self.author)
+        jobs.enqueue(self.ads[1], self.author)
+        with mock.patch('board.jobs.kandinsky_query', side_effect=['ok.jpg', 'Error: (401,)']):
+            jobs.run_job(jobs.claim_next())
+            jobs.run_job(jobs.claim_next())
+        states = dict(GenerationJob.objects.values_list('advertisement', 'state'))
+        self.assertEqual(states, {self.ads[0].id: GenerationJob.DONE, self.ads[1].id: GenerationJob.FAILED})
+        self.assertFalse(Image.objects.filter(advertisement=self.ads[1]).exists())
+        # После завершения можно поставить новую генерацию
+        self.assertEqual(jobs.enqueue(self.ads[0], self.author).state, GenerationJob.QUEUED)
+
+    def test_recover_stale(self):
+        jobs.enqueue(self.ads[0], self.author)
+        job = jobs.claim_next()
+        GenerationJob.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.recover_stale(), 1)
+        self.assertEqual(jobs.claim_next().id, job.id)
+
+
+class QueueResumeTest(TestCase):
+    """  Незавершенные генерации продолжаются после перезапуска процесса  """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user('author', password='pass')
+        cls.adv = Advertisement.objects.create(title='Объявление', content='Текст', author=cls.author)
+
+    def setUp(self):
+        override = override_settings(KANDINSKY_WORKER='command')
+        override.enable()
+        self.job = jobs.enqueue(self.adv, self.author)
+        override.disable()
+
+    def test_repeated_click_wakes_dispatcher(self):
+        with mock.patch('board.jobs.start_dispatcher') as start:
+            self.assertEqual(jobs.enqueue(self.adv, self.author), self.job)
+        start.assert_called_once()
+
+    def test_first_request_resumes_queue(self):
+        request_started.connect(jobs.resume_queue, dispatch_uid=jobs.RESUME_UID)
+        with mock.patch('board.jobs.start_dispatcher') as start:
+            self.client.get(reverse('home'))
+            self.client.get(reverse('home'))
+        start.assert_called_once()
+
+    def test_dispatcher_waits_for_running_jobs(self):
+        GenerationJob.objects.filter(id=self.job.id).update(state=GenerationJob.RUNNING)
+        self.assertFalse(jobs.Dispatcher().finish())
+        GenerationJob.objects.filter(id=self.job.id).update(state=GenerationJob.DONE)
+        self.assertTrue(jobs.Dispatcher().finish())
+
+
+class WriteBase64Test(SimpleTestCase):
+    """  Запись сгенерированной картинки  """
+
+    def test_atomic_write(self):
+        data = os.urandom(300 * 1024)
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'kandinsky', 'img.jpg')
+            kandinsky.write_base64(base64.b64encode(data).decode(), path, chunk_size=4096)
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), data)
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['img.jpg'])
+
+    def test_broken_data_keeps_old_file(self):
+        with tempfile.TemporaryDirectory() as dir_:
+            path = os.path.join(dir_, 'img.jpg')
+            with open(path, 'wb') as file:
+                file.write(b'old')
+            with self.assertRaises(ValueError):
+                kandinsky.write_base64('not base64!', path)
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), b'old')
+            self.assertEqual(os.listdir(dir_), ['img.jpg'])
+
+
+class FakeKandinsky:
+    """  Локальный сервер, имитирующий API Kandinsky  """
+
+    def __init__(self, fail_first: int = 0, fail: str = 'run'):
+        self.fail_first = fail_first
+        self.fail = fail
+        self.model = 4
+        self.peers = set()
+        self.calls = []
+        self.app = web.Application()
+        self.app.router.add_get('/key/api/v1/models', self.models)
+        self.app.router.add_post('/key/api/v1/text2image/run', self.run)
+        self.app.router.add_get('/key/api/v1/text2image/status/{uuid}', self.status)
+
+    def track(self, request, name) -> bool:
+        """  Записать вызов; True - ответить ошибкой 503  """
+        self.peers.add(request.transport.get_extra_info('peername'))
+        self.calls.append(name)
+        if self.fail_first and name == self.fail:
+            self.fail_first -= 1
+            return True
+        return False
+
+    async def models(self, request):
+        self.track(request, 'models')
+        return web.json_response([{'id': self.model}])
+
+    async def run(self, request):
+        if self.track(request, 'run'):
+            return web.Response(status=503)
+        form = await request.post()
+        if form['model_id'] != str(self.model):
+            return web.json_response({'error': 'model not found'}, status=404)
+        return web.json_response({'uuid': 'job-1'})
+
+    async def status(self, request):
+        if self.track(request, 'status'):
+            return web.Response(status=503)
+        image = base64.b64encode(b'JPEG' + request.match_info['uuid'].encode()).decode()
+        return web.json_response({'status': 'DONE', 'images': [image]})
+
+
+class KandinskyClientTest(SimpleTestCase):
+    """  Асинхронный клиент API Kandinsky против локального сервера  """
+
+    @contextlib.asynccontextmanager
+    async def serve(self, fake: FakeKandinsky):
+        server = TestServer(fake.app)
+        await server.start_server()
+        api = kandinsky.Text2ImageAPI(str(server.make_url('/')), 'key', 'secret', backoff=0.01)
+        try:
+            yield api
+        finally:
+            await api.close()
+            await server.close()
+
+    async def test_gen_reuses_connection(self):
+        fake = FakeKandinsky()
+        with tempfile.TemporaryDirectory() as dir_:
+            async with self.serve(fake) as api:
+                path = await kandinsky.gen('кот', dirr=dir_, file_name='cat.jpg', api=api)
+            with open(path, 'rb') as file:
+                self.assertEqual(file.read(), b'JPEGjob-1')
+        self.assertEqual(fake.calls, ['models', 'run', 'status'])
+        self.assertEqual(len(fake.peers), 1)
+
+    async def test_retry_on_server_error(self):
+        fake = FakeKandinsky(fail_first=2, fail='status')
+        async with self.serve(fake) as api:
+            self.assertEqual(await api.request('GET', 'key/api/v1/text2image/status/job-1'),
+                             {'status': 'DONE', 'images': [base64.b64encode(b'JPEGjob-1').decode()]})
+        self.assertEqual(fake.calls, ['status', 'status', 'status'])
+
+    async def test_run_not_repeated(self):
+        fake = FakeKandinsky(fail_first=1)
+        async with self.serve(fake) as api:
+            # Сервер мог запустить генерацию до ошибки - повтор запустил бы вторую
+            with self.assertRaises(ClientResponseError):
+                await api.generate('кот', fake.model)
+        self.assertEqual(fake.calls, ['run'])
+
+    async def test_run_retried_without_connection(self):
+        fake = FakeKandinsky()
+        async with self.serve(fake) as api:
+            connector = (await api.session()).connector
+            connect = connector.connect
+            failures = iter([ClientConnectorError(mock.Mock(), OSError('refused'))])
+
+            async def connect_once(*args, **kwargs):
+                error = next(failures, None)
+                if error:
+                    raise error
+                return await connect(*args, **kwargs)
+
+            with mock.patch.object(connector, 'connect', connect_once):
+                self.assertEqual(await api.generate('кот', fake.model), 'job-1')
+            self.assertEqual(list(failures), [])
+        self.assertEqual(fake.calls, ['run'])
+
+    async def test_concurrent_generations(self):
+        fake = FakeKandinsky()
+        with tempfile.TemporaryDirectory() as dir_:
+            async with self.serve(fake) as api:
+                paths = await asyncio.gather(*(kandinsky.gen('кот', dirr=dir_, file_name=f'{i}.jpg', api=api)
+                                               for i in range(5)))
+            self.assertEqual(sorted(os.listdir(dir_)), sorted(os.path.basename(p) for p in paths))
+        self.assertEqual(fake.calls.count('run'), 5)
+        self.assertEqual(fake.calls.count('models'), 1)
+
+    async def test_model_id_cached(self):
+        fake = FakeKandinsky()
+        async with self.serve(fake) as api:
+            for _ in range(3):
+                await api.submit('кот')
+        self.assertEqual(fake.calls, ['models', 'run', 'run', 'run'])
+
+    async def test_model_refreshed_in_background(self):
+        fake = FakeKandinsky()
+        async with self.serve(fake) as api:
+            api.model_ttl = 0
+            await api.submit('кот')
+            fake.model = 5
+            # Срок кеша истек: генерация не ждет запроса модели, новый id приходит в фоне
+            self.assertEqual(await api.model_id(), 4)
+            await api._model_refresh
+            self.assertEqual(api._model_id, 5)
+
+    async def test_model_not_found_invalidates(self):
+        fake = FakeKandinsky()
+        async with self.serve(fake) as api:
+            await api.submit('кот')
+            fake.model = 5
+            self.assertEqual(await api.submit('кот'), 'job-1')
+        self.assertEqual(fake.calls, ['models', 'run', 'run', 'models', 'run'])
@@ -0,0 +1,130 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image as PilImage
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+# Заглушка, которая показывается вместо картинки, пока Kandinsky ее генерирует
+PLACEHOLDER = 'gen.jpg'
+
+_pool = None
+
+
+def thumb_name(name: str, size: str) -> str:
+    """
+    Имя файла уменьшенной копии картинки относительно MEDIA_ROOT
+    :param name: Имя исходного файла относительно MEDIA_ROOT.
+    :param size: Размер из settings.THUMBNAIL_SIZES ('list', 'detail').
+    :return: Имя файла уменьшенной копии (полное имя исходного файла сохраняется, чтобы
+    x.png и x.jpg не получили одну копию).
+    """
+    return f'thumbs/{size}/{name}.jpg'
+
+
+def render_thumbnail(src: str, dst: str, height: int):
+    """
+    Сделать уменьшенную копию картинки заданной высоты. Выполняется в пуле процессов,
+    поэтому работает только с путями файлов.
+    :param src: Полный путь исходной картинки.
+    :param dst: Полный путь уменьшенной копии.
+    :param height: Высота уменьшенной копии в пикселях.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f'{dst}.{os.getpid()}.tmp'
+    with PilImage.open(src) as img:
+        img.draft('RGB', (height * 4, height))
+        img = img.convert('RGB')
+        img.thumbnail((height * 4, height))
+        img.save(tmp, 'JPEG', quality=85, optimize=True)
+    os.replace(tmp, dst)
+
+
+def is_fresh(name: str, size: str) -> bool:
+    """
+    Есть ли актуальная уменьшенная копия (не старше исходной картинки)
+    :param name: Имя исходного файла относительно MEDIA_ROOT.
+    :param size: Размер из settings.THUMBNAIL_SIZES.
+    """
+    try:
+        return (os.stat(os.path.join(settings.MEDIA_ROOT, thumb_name(name, size))).st_mtime
+                >= os.stat(os.path.join(settings.MEDIA_ROOT, name)).st_mtime)
+    except OSError:
+        return False
+
+
+def generate(name: str, sizes=None) -> list[str]:
+    """
+    Сделать недостающие или устаревшие уменьшенные копии картинки
+    :param name: Имя исходного файла относительно MEDIA_ROOT.
+    :param sizes: Размеры (по умолчанию все из settings.THUMBNAIL_SIZES).
+    :return: Список созданных файлов.
+    """
+    made = []
+    for size in sizes or settings.THUMBNAIL_SIZES:
+        if not is_fresh(name, size):
+            dst = thumb_name(name, size)
+            render_thumbnail(os.path.join(settings.MEDIA_ROOT, name), os.path.join(settings.MEDIA_ROOT, dst),
+                             settings.THUMBNAIL_SIZES[size])
+            made.append(dst)
+    return made
+
+
+def _log_result(future):
+    if future.exception():
+        logging.error(f'Ошибка создания уменьшенной копии: {future.exception()}')
+
+
+def schedule(*names: str):
+    """
+    Поставить создание уменьшенных копий в очередь пула процессов, чтобы не задерживать
+    ответ пользователю. При THUMBNAIL_WORKERS = 0 копии создаются сразу.
+    :param names: Имена исходных файлов относительно MEDIA_ROOT.
+    """
+    global _pool
+    for name in filter(None, names):
+        if not settings.THUMBNAIL_WORKERS:
+            try:
+                generate(name)
+            except Exception as er:
+                logging.error(f'Ошибка создания уменьшенной копии {name}: {er}')
+            continue
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.THUMBNAIL_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        for size, height in settings.THUMBNAIL_SIZES.items():
+            future = _pool.submit(render_thumbnail, os.path.join(settings.MEDIA_ROOT, name),
+                                  os.path.join(settings.MEDIA_ROOT, thumb_name(name, size)), height)
+            future.add_done_callback(_log_result)
+
+
+def source_name(name: str) -> str:
+    """
+    Имя файла, который нужно показать: сама картинка или заглушка, если файла еще нет
+    (картинка генерируется)
+    :param name: Имя файла относительно MEDIA_ROOT.
+    """
+    return name if os.path.exists(os.path.join(settings.MEDIA_ROOT, name)) else PLACEHOLDER
+
+
+def image_url(name: str) -> str:
+    """
+    Адрес картинки или заглушки, если файла еще нет
+    :param name: Имя файла относительно MEDIA_ROOT.
+    """
+    return default_storage.url(source_name(name))
+
+
+def thumbnail_url(name: str, size: str) -> str:
+    """
+    Адрес уменьшенной копии картинки - всегда адрес представления thumbnail, которое отдает
+    готовую копию, создает ее по требованию или отдает копию заглушки. Адрес не зависит
+    от состояния файлов, поэтому его можно хранить в кеше карточек, а при отрисовке
+    не нужно обращаться к файловой системе.
+    :param name: Имя исходного файла относительно MEDIA_ROOT.
+    :param size: Размер из settings.THUMBNAIL_SIZES.
+    """
+    return reverse('board:thumbnail', kwargs={'size': size, 'name': name})
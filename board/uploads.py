@@ -0,0 +1,109 @@
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopUpload
+from django.db import transaction
+
+from .models import Image
+from .utilite import advertisement_keys, bump_version
+from . import thumbnails
+
+# Сигнатуры (первые байты) допустимых форматов картинок
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+def image_type(head: bytes) -> str | None:
+    """
+    Тип картинки по первым байтам файла (заявленному браузером типу не доверяем)
+    :param head: Начало файла.
+    :return: MIME-тип или None, если формат не поддерживается.
+    """
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Обработчик загрузки картинок: файлы частями пишутся во временные файлы на диске,
+    формат и размер проверяются по мере получения данных. Файл неподходящего формата
+    или больше IMAGE_UPLOAD_MAX_SIZE пропускается сразу, при превышении IMAGE_UPLOAD_MAX_FILES
+    или IMAGE_UPLOAD_MAX_TOTAL загрузка прекращается. Ошибки собираются в errors.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.errors = []
+        self.count = 0
+        self.total = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.count += 1
+        if self.count > settings.IMAGE_UPLOAD_MAX_FILES:
+            self.errors.append(f'Можно загрузить не больше {settings.IMAGE_UPLOAD_MAX_FILES} файлов за раз')
+            raise StopUpload()
+        self.file = TemporaryUploadedFile(self.file_name, self.content_type, 0, self.charset,
+                                          self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0:
+            content_type = image_type(raw_data)
+            if content_type is None:
+                self.errors.append(f'{self.file_name}: файл не является картинкой JPEG, PNG, GIF или WEBP')
+                raise SkipFile()
+            self.file.content_type = content_type
+        self.total += len(raw_data)
+        if start + len(raw_data) > settings.IMAGE_UPLOAD_MAX_SIZE:
+            self.errors.append(f'{self.file_name}: файл больше {settings.IMAGE_UPLOAD_MAX_SIZE // 2 ** 20} МБ')
+            raise SkipFile()
+        if self.total > settings.IMAGE_UPLOAD_MAX_TOTAL:
+            self.errors.append(f'Общий размер файлов больше {settings.IMAGE_UPLOAD_MAX_TOTAL // 2 ** 20} МБ')
+            raise StopUpload()
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        if not file_size:
+            self.errors.append(f'{self.file_name}: пустой файл')
+            self.file.close()
+            return None
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
+
+
+def save_images(advertisement, user, files) -> list[Image]:
+    """
+    Сохранить загруженные картинки объявления: файлы переносятся из временных в хранилище,
+    строки добавляются одним INSERT (bulk_create), уменьшенные копии создаются в фоне
+    после фиксации транзакции. bulk_create не вызывает сигналы, поэтому версия объявления
+    меняется здесь один раз на всю загрузку.
+    :param advertisement: Объявление.
+    :param user: Пользователь, загрузивший картинки.
+    :param files: Загруженные файлы.
+    :return: Созданные картинки.
+    """
+    field = Image._meta.get_field('image')
+    images = []
+    try:
+        for file in files:
+            image = Image(advertisement=advertisement, user=user)
+            image.image = field.storage.save(field.generate_filename(image, file.name), file,
+                                             max_length=field.max_length)
+            images.append(image)
+        with transaction.atomic():
+            Image.objects.bulk_create(images)
+            bump_version(*advertisement_keys(advertisement.id, advertisement.author_id))
+    except BaseException:
+        for image in images:
+            field.storage.delete(image.image.name)
+        raise
+    transaction.on_commit(lambda: thumbnails.schedule(*(image.image.name for image in images)))
+    return images
@@ -1,7 +1,7 @@
 # from django.conf import settings
 # from django.conf.urls.static import static
 from django.urls import path
-from . import views
+from . import api, views
 
 app_name = 'board'
 
@@ -9,8 +9,16 @@ urlpatterns = [
     path('', views.advertisement_list, name='advertisement_list'),
     path('stat/', views.user_stat_list, name='user_stat_list'),
     path('settings/', views.user_settings, name='user_settings'),
+    path('changes/', views.board_changes, name='board_changes'),
+    path('search/', views.board_search, name='search'),
+    path('api/v1/feed/', api.feed, name='api_feed'),
+    path('api/v1/advertisements/<int:pk>/', api.advertisement, name='api_advertisement'),
+    path('api/v1/advertisements/<int:pk>/comments/', api.comments, name='api_comments'),
+    path('api/v1/stats/', api.stats, name='api_stats'),
+    path('thumb/<str:size>/<path:name>', views.thumbnail, name='thumbnail'),
     path('<int:pk>/', views.advertisement_list, name='advertisement_list'),
     path('advertisement/<int:pk>/', views.advertisement_detail, name='advertisement_detail'),
+    path('advertisement/<int:pk>/comments/', views.advertisement_comments, name='advertisement_comments'),
     path('edit/<int:pk>/', views.edit_advertisement, name='edit_advertisement'),
     path('edit_comment/<int:pk>/', views.edit_comment, name='edit_comment'),
     path('delete_comment/<int:pk>/', views.delete_comment, name='delete_comment'),
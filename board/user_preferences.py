@@ -1,5 +1,5 @@
 from django.http import HttpRequest
-from .models import Preferences
+from .utilite import read_preferences, save_preferences
 
 
 def pref(request: HttpRequest):
@@ -9,20 +9,9 @@ def pref(request: HttpRequest):
     :param request: HttpRequest - запрос пользователя
     :return: Пользовательские предпочтения
     """
-    if request.user.is_authenticated:
-        _preferences = Preferences.objects.filter(user=request.user).last()
-        if request.GET.get('day') == 'theme':
-            if not _preferences or _preferences.theme is None:
-                Preferences.objects.create(user=request.user, theme='dark')
-            elif _preferences.theme == 'light':
-                _preferences.theme = 'dark'
-                _preferences.save()
-            else:
-                _preferences.theme = 'light'
-                _preferences.save()
-            _preferences = Preferences.objects.filter(user=request.user).last()
-    else:
-        _preferences = None
+    _preferences = read_preferences(request)
+    if _preferences and request.GET.get('day') == 'theme':
+        _preferences = save_preferences(request, theme='light' if _preferences['theme'] == 'dark' else 'dark')
     return {
         'user_pref': _preferences,
     }
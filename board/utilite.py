@@ -1,12 +1,24 @@
-import asyncio
+import functools
+import hashlib
 import logging
 import os
+import random
+import time
+from datetime import datetime, timezone as dt_timezone
 
 from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F, Q
 from django.http import HttpRequest
+from django.utils import timezone
 
-from .models import Like, Advertisement, Preferences
-from .kandinsky import gen
+from .models import Like, Advertisement, Comment, Preferences, BoardVersion, UserStat
+from .kandinsky import gen, run
+from .pagination import decode_cursor, encode_cursor
+from . import thumbnails
+
+# Ключ сессии с настройками пользователя
+PREFERENCES_SESSION_KEY = 'board_preferences'
 
 
 def decor_log(func):
@@ -23,125 +35,341 @@ def decor_log(func):
     return log_writer
 
 
-def like_read(request: HttpRequest, pk: int) -> dict:
+def retry_locked(func):
+    """
+    Декоратор для повтора записи в SQLite, получившей "database is locked". Повтор выполняется
+    с экспоненциальной задержкой со случайной добавкой (чтобы процессы не просыпались одновременно)
+    и только вне внешней транзакции: функция повторяется целиком.
+    :return: полученную обернутую функцию
+    """
+    @functools.wraps(func)
+    def retry_writer(*args, **kwargs):
+        for attempt in range(settings.DB_LOCK_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as er:
+                if ('locked' not in str(er) or attempt == settings.DB_LOCK_RETRIES
+                        or connection.in_atomic_block):
+                    raise
+                logging.warning(f'{func.__name__}: {er}, повтор {attempt + 1}')
+            time.sleep(settings.DB_LOCK_RETRY_DELAY * 2 ** attempt * (1 + random.random() / 2))
+
+    return retry_writer
+
+
+@retry_locked
+def bump_version(*keys: str):
+    """
+    Увеличить счетчики версий данных доски
+    :param keys: Ключи счетчиков (например, 'board').
+    """
+    updated = BoardVersion.objects.filter(key__in=keys).update(version=F('version') + 1,
+                                                                updated_at=timezone.now())
+    if updated < len(keys):
+        BoardVersion.objects.bulk_create([BoardVersion(key=key, version=1) for key in keys],
+                                         ignore_conflicts=True)
+
+
+@retry_locked
+def change_user_stat(user_id: int, upsert: bool = True, **deltas: int):
+    """
+    Изменить счетчики статистики пользователя одним запросом на стороне базы
+    (без чтения строки в Python)
+    :param user_id: id пользователя.
+    :param upsert: Создать строку статистики, если ее еще нет (INSERT ... ON CONFLICT DO UPDATE).
+    При удалении объектов строку создавать не нужно - только уменьшить существующую.
+    :param deltas: Изменения счетчиков, например like_count=1, dislike_count=-1.
+    """
+    if not upsert:
+        UserStat.objects.filter(user_id=user_id).update(**{field: F(field) + delta for field, delta in deltas.items()})
+        return
+    table = connection.ops.quote_name(UserStat._meta.db_table)
+    fields = [UserStat._meta.get_field(field).column for field in deltas]
+    user_column = UserStat._meta.get_field('user').column
+    columns = ', '.join(connection.ops.quote_name(column) for column in [user_column, *fields])
+    updates = ', '.join(f'{connection.ops.quote_name(column)} = {table}.{connection.ops.quote_name(column)} + %s'
+                        for column in fields)
+    counters = [field.column for field in UserStat._meta.concrete_fields
+                if isinstance(field.default, int) and field.column not in fields]
+    defaults = ''.join(f', {connection.ops.quote_name(column)}' for column in counters)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({columns}{defaults}) '
+            f'VALUES (%s{", %s" * len(fields)}{", 0" * len(counters)}) '
+            f'ON CONFLICT ({connection.ops.quote_name(user_column)}) DO UPDATE SET {updates}',
+            [user_id, *[max(delta, 0) for delta in deltas.values()], *deltas.values()])
+
+
+def advertisement_keys(advertisement_id: int, author_id: int | None = None) -> list[str]:
+    """
+    Ключи счетчиков версий, которые меняются вместе с объявлением
+    :param advertisement_id: id объявления.
+    :param author_id: id автора объявления (если известен - меняется и лента автора).
+    :return: Список ключей: вся доска, общая лента, лента автора, само объявление.
     """
-    Узнать количество лайков и дизлайков на выбранном сообщении
+    keys = ['board', 'feed', f'adv:{advertisement_id}']
+    if author_id:
+        keys.append(f'author:{author_id}')
+    return keys
+
+
+def read_version(key: str = 'board') -> int:
+    """
+    Текущая версия данных доски
+    :param key: Ключ счетчика.
+    :return: Номер версии (0, если изменений еще не было).
+    """
+    return BoardVersion.objects.filter(key=key).values_list('version', flat=True).first() or 0
+
+
+def read_stamps(request: HttpRequest, keys: list[str]) -> dict:
+    """
+    Прочитать версии и время изменения сразу нескольких счетчиков одним запросом.
+    Результат запоминается в запросе, чтобы представление не читало их повторно.
     :param request: HttpRequest - запрос пользователя.
-    :param pk: id объявления.
-    :return: Словарь с количеством лайков и дизлайков
+    :param keys: Ключи счетчиков.
+    :return: Словарь {ключ: (версия, время изменения или None)}.
     """
-    context = {}
-    if request.user.is_authenticated:
-        count_like = len(Like.objects.filter(advertisement=pk, user=request.user.id, like_type=1))
-        if count_like:
-            context['like'] = count_like
-        count_like = len(Like.objects.filter(advertisement=pk, user=request.user.id, like_type=0))
-        if count_like:
-            context['dislike'] = count_like
-    return context
+    stamps = request.__dict__.setdefault('_board_stamps', {})
+    missing = [key for key in keys if key not in stamps]
+    if missing:
+        stamps.update({key: (0, None) for key in missing})
+        for key, version, updated_at in BoardVersion.objects.filter(key__in=missing).values_list(
+                'key', 'version', 'updated_at'):
+            stamps[key] = (version, updated_at)
+    return {key: stamps[key] for key in keys}
 
 
-def like_set(request: HttpRequest, pk: int, tp: int):
+def page_etag(request: HttpRequest, key: str) -> str | None:
     """
-    Поставить или убрать лайк/дизлайк
+    ETag страницы по версии ресурса и настроек пользователя, вычисляется без шаблонов.
+    Запросы, меняющие настройки (?day=, ?cnt=), не кешируются.
     :param request: HttpRequest - запрос пользователя.
-    :param pk: id объявления.
-    :param tp: Тип лайка (1 - лайк, 0 - дизлайк)
+    :param key: Ключ счетчика версии ресурса (feed, author:<id>, adv:<id>).
+    :return: ETag или None.
     """
+    if 'day' in request.GET or 'cnt' in request.GET:
+        return None
+    keys = [key]
     if request.user.is_authenticated:
-        advertisement = Advertisement.objects.get(pk=pk)
-        like = Like.objects.filter(advertisement=pk, user=request.user.id, like_type=1).first()
-        dislike = Like.objects.filter(advertisement=pk, user=request.user.id, like_type=0).first()
-        if tp == 1:
-            if like:
-                like.delete()
-                advertisement.like_count = int(advertisement.like_count) - 1
-            else:
-                Like.objects.create(advertisement=advertisement, user=request.user, like_type=1)
-                advertisement.like_count = int(advertisement.like_count) + 1
-                if dislike:
-                    dislike.delete()
-                    advertisement.dislike_count = int(advertisement.dislike_count) - 1
-            advertisement.save()
-        if tp == 0:
-            if dislike:
-                dislike.delete()
-                advertisement.dislike_count = int(advertisement.dislike_count) - 1
-            else:
-                Like.objects.create(advertisement=advertisement, user=request.user, like_type=0)
-                advertisement.dislike_count = int(advertisement.dislike_count) + 1
-                if like:
-                    like.delete()
-                    advertisement.like_count = int(advertisement.like_count) - 1
-            advertisement.save()
-    return
+        keys.append(f'user:{request.user.id}')
+    stamps = read_stamps(request, keys)
+    parts = [f'{k}={version}' for k, (version, _) in stamps.items()]
+    parts += [str(request.user.id), request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')]
+    return hashlib.md5('|'.join(parts).encode()).hexdigest()
 
 
-def read_pade_count(request: HttpRequest) -> int:
+def page_last_modified(request: HttpRequest, key: str) -> datetime | None:
     """
-    Определить количество объявлений на страницу для пагинации учитывая предпочтения пользователя.
+    Время последнего изменения ресурса. Отдается только анонимным пользователям:
+    страницы авторизованных зависят от пользователя, для них достаточно ETag.
     :param request: HttpRequest - запрос пользователя.
-    :return: Количество объявлений на страницу.
+    :param key: Ключ счетчика версии ресурса.
+    :return: Время изменения или None.
     """
-    cnt = request.GET.get('cnt')
-    if not request.user.is_authenticated:
-        cnt = settings.PAGE_DEFAULT
-    elif cnt is None or int(cnt) == 0:
-        try:
-            cnt = Preferences.objects.get(user=request.user).page_num
-        except:
-            cnt = settings.PAGE_DEFAULT
-            Preferences.objects.create(user=request.user, page_num=cnt)
+    if request.user.is_authenticated or 'day' in request.GET or 'cnt' in request.GET:
+        return None
+    return read_stamps(request, [key])[key][1]
+
+
+def like_states(user, advertisement_ids) -> dict[int, int]:
+    """
+    Оценки пользователя для списка объявлений одним запросом
+    :param user: Пользователь (для анонимного запрос не выполняется).
+    :param advertisement_ids: id объявлений.
+    :return: Словарь {id объявления: тип оценки (1 - лайк, 0 - дизлайк)}, без неоцененных объявлений.
+    """
+    if not user.is_authenticated or not advertisement_ids:
+        return {}
+    return dict(Like.objects.filter(user_id=user.id, advertisement_id__in=list(advertisement_ids))
+                .values_list('advertisement_id', 'like_type'))
+
+
+def like_read(request: HttpRequest, pk: int) -> dict:
+    """
+    Узнать, поставил ли пользователь лайк или дизлайк выбранному объявлению
+    :param request: HttpRequest - запрос пользователя.
+    :param pk: id объявления.
+    :return: Словарь {'like': 1} или {'dislike': 1}, пустой если оценки нет
+    """
+    like_type = like_states(request.user, [pk]).get(pk)
+    if like_type is None:
+        return {}
+    return {'like' if like_type == 1 else 'dislike': 1}
+
+
+def comments_page(advertisement_id: int, after: str | None = None, per_page: int | None = None,
+                  fields: list[str] | None = None) -> tuple[list, str | None]:
+    """
+    Страница комментариев объявления в порядке добавления. Страницы выбираются по курсору
+    (время, id) - по индексу (advertisement, created_at), без OFFSET; авторы подгружаются JOIN.
+    :param advertisement_id: id объявления.
+    :param after: Курсор - комментарии после указанного.
+    :param per_page: Количество комментариев на страницу (по умолчанию settings.COMMENTS_PAGE_SIZE).
+    :param fields: Поля для values() - строки возвращаются словарями без создания объектов моделей.
+    :return: Комментарии и курсор следующей страницы (None, если страница последняя).
+    """
+    per_page = per_page or settings.COMMENTS_PAGE_SIZE
+    comments = Comment.objects.filter(advertisement_id=advertisement_id).order_by('created_at', 'id')
+    if fields:
+        comments = comments.values('id', 'created_at', *fields)
     else:
-        try:
-            Preferences.objects.filter(user=request.user).update(page_num=cnt)
-        except Exception as er:
-            logging.error(f'Ошибка: {er}')
-    return cnt
+        comments = comments.select_related('author')
+    cursor = decode_cursor(after, 2)
+    if cursor:
+        created_at = datetime.fromtimestamp(cursor[0] / 1_000_000, tz=dt_timezone.utc)
+        comments = comments.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=cursor[1]))
+    comments = list(comments[:per_page + 1])
+    if len(comments) <= per_page:
+        return comments, None
+    last = comments[per_page - 1]
+    last_id, last_created = (last['id'], last['created_at']) if fields else (last.id, last.created_at)
+    return comments[:per_page], encode_cursor(round(last_created.timestamp() * 1_000_000), last_id)
+
+
+def delete_like(pk: int, user_id: int, tp: int) -> int:
+    """
+    Удалить оценку одним DELETE, без выборки строк и сигналов delete() (на Like не ссылаются
+    внешние ключи других таблиц, счетчики меняет вызывающий код)
+    :param pk: id объявления.
+    :param user_id: id пользователя.
+    :param tp: Тип лайка.
+    :return: Количество удаленных строк.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {connection.ops.quote_name(Like._meta.db_table)} '
+                       f'WHERE advertisement_id = %s AND user_id = %s AND like_type = %s', [pk, user_id, tp])
+        return cursor.rowcount
+
+
+@retry_locked
+def like_set(request: HttpRequest, pk: int, tp: int):
+    """
+    Поставить или убрать лайк/дизлайк. Оценка пользователя хранится в одной строке Like
+    (уникальна пара объявление-пользователь), поэтому переключение выполняется условными
+    UPDATE/DELETE/INSERT, а счетчики меняются выражениями F() на стороне базы.
+    Результат не зависит от параллельных запросов, сигналы Advertisement не вызываются.
+    :param request: HttpRequest - запрос пользователя.
+    :param pk: id объявления.
+    :param tp: Тип лайка (1 - лайк, 0 - дизлайк)
+    """
+    if not request.user.is_authenticated or tp not in (0, 1):
+        return
+    field, other = ('like_count', 'dislike_count') if tp == 1 else ('dislike_count', 'like_count')
+    likes = Like.objects.filter(advertisement_id=pk, user_id=request.user.id)
+    with transaction.atomic():
+        if likes.exclude(like_type=tp).update(like_type=tp):
+            deltas = {field: 1, other: -1}
+        elif delete_like(pk, request.user.id, tp):
+            deltas = {field: -1}
+        else:
+            try:
+                with transaction.atomic():
+                    Like.objects.bulk_create([Like(advertisement_id=pk, user_id=request.user.id, like_type=tp)])
+                deltas = {field: 1}
+            except IntegrityError:
+                # Параллельный запрос уже поставил эту оценку
+                return
+        author_id = Advertisement.objects.filter(pk=pk).values_list('author_id', flat=True).first()
+        if author_id is None:
+            raise Advertisement.DoesNotExist
+        Advertisement.objects.filter(pk=pk).update(**{name: F(name) + delta for name, delta in deltas.items()})
+        change_user_stat(request.user.id, **deltas)
+        # Счетчики показываются в лентах, а оценка видна только этому пользователю -
+        # меняются версии лент, объявления и страниц пользователя
+        bump_version(*advertisement_keys(pk, author_id), f'user:{request.user.id}')
 
 
 @decor_log
-def kandinsky_query(text: str = 'пустота', dir_='./', file_='image.jpg') -> str:
+def kandinsky_query(text: str = 'пустота', dir_='./', file_='image.jpg', keys=('board',)) -> str:
     """
     Отправка и обработка запроса на генерацию картинки Kandinsky 3.0
     :param text: текст запроса
     :param dir_: Директория вывода.
     :param file_: Файл вывода.
+    :param keys: Счетчики версий, которые нужно увеличить, когда картинка готова.
     :return: Картеж, содержащий имя сформированного файла и текст самого запроса
     для логирования
     """
 
     try:
-        file_name = asyncio.run(gen(text.replace("\n", " "), dirr=dir_, file_name=file_))
+        file_name = run(gen(text.replace("\n", " "), dirr=dir_, file_name=file_))
+        thumbnails.schedule(os.path.relpath(file_name, settings.MEDIA_ROOT).replace("\\", "/"))
+        # Картинка готова - сообщаем открытым страницам об изменениях
+        bump_version(*keys)
     except Exception as err:
         file_name = f'Error: {err.args}'
+    finally:
+        connection.close()
     return file_name
 
-def read_pade_count(request: HttpRequest) -> int:
+def read_preferences(request: HttpRequest) -> dict | None:
     """
-    Возвращает количество объявлений на страницу (int).
+    Настройки пользователя (тема, количество объявлений на страницу). Читаются из базы
+    не чаще раза в PREFERENCES_TTL секунд и хранятся в сессии, в пределах запроса - в самом запросе.
+    :param request: HttpRequest - запрос пользователя.
+    :return: Словарь настроек или None для анонимного пользователя.
     """
-    cnt = request.GET.get("cnt")
-
-    # Неавторизованный пользователь — просто дефолт
     if not request.user.is_authenticated:
-        return int(settings.PAGE_DEFAULT)
+        return None
+    prefs = request.__dict__.get('_board_preferences')
+    if prefs is None:
+        prefs = request.session.get(PREFERENCES_SESSION_KEY)
+        if (prefs is None or prefs.get('user_id') != request.user.id
+                or time.time() - prefs.get('loaded_at', 0) > settings.PREFERENCES_TTL):
+            preferences, _ = Preferences.objects.get_or_create(user_id=request.user.id)
+            prefs = remember_preferences(request, preferences)
+        request._board_preferences = prefs
+    return prefs
+
+
+def remember_preferences(request: HttpRequest, preferences: Preferences) -> dict:
+    """
+    Запомнить настройки пользователя в сессии и в запросе
+    :param request: HttpRequest - запрос пользователя.
+    :param preferences: Настройки из базы.
+    :return: Словарь настроек.
+    """
+    prefs = {'user_id': preferences.user_id, 'theme': preferences.theme, 'page_num': preferences.page_num,
+             'loaded_at': time.time()}
+    request.session[PREFERENCES_SESSION_KEY] = request._board_preferences = prefs
+    return prefs
+
+
+@retry_locked
+def save_preferences(request: HttpRequest, **changes) -> dict:
+    """
+    Изменить настройки пользователя: запись в базу и в сессию выполняется только
+    если значения действительно изменились.
+    :param request: HttpRequest - запрос пользователя.
+    :param changes: Новые значения (theme=..., page_num=...).
+    :return: Словарь настроек.
+    """
+    prefs = read_preferences(request)
+    changed = {field: value for field, value in changes.items() if prefs[field] != value}
+    if changed:
+        Preferences.objects.filter(user_id=request.user.id).update(**changed)
+        bump_version(f'user:{request.user.id}')
+        prefs = {**prefs, **changed}
+        request.session[PREFERENCES_SESSION_KEY] = request._board_preferences = prefs
+    return prefs
 
-    # Если cnt не передан — берём из Preferences
-    if cnt is None or cnt == "" or cnt == "0":
-        try:
-            cnt = Preferences.objects.get(user=request.user).page_num
-        except Preferences.DoesNotExist:
-            cnt = settings.PAGE_DEFAULT
-            Preferences.objects.create(user=request.user, page_num=cnt)
-        return int(cnt)
 
-    # Если cnt передан — обновляем Preferences
+def read_pade_count(request: HttpRequest) -> int:
+    """
+    Определить количество объявлений на страницу для пагинации учитывая предпочтения пользователя.
+    Переданное ?cnt= запоминается в настройках.
+    :param request: HttpRequest - запрос пользователя.
+    :return: Количество объявлений на страницу.
+    """
+    if not request.user.is_authenticated:
+        return int(settings.PAGE_DEFAULT)
+    cnt = request.GET.get('cnt')
+    if cnt in (None, '', '0'):
+        return int(read_preferences(request)['page_num'])
     try:
-        cnt_int = int(cnt)
-        Preferences.objects.filter(user=request.user).update(page_num=cnt_int)
-        return cnt_int
-    except Exception as er:
-        logging.error(f"Ошибка: {er}")
+        cnt = int(cnt)
+    except ValueError as er:
+        logging.error(f'Ошибка: {er}')
         return int(settings.PAGE_DEFAULT)
-
+    return save_preferences(request, page_num=cnt)['page_num']
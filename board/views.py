@@ -1,24 +1,27 @@
 import logging
 import os
-import shutil
-import time
-from datetime import datetime
+import re
 # from multiprocessing import Process
-from threading import Thread
 
 from django.core.paginator import Paginator
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import HttpRequest, HttpResponseRedirect, HttpResponse
+from django.http import HttpRequest, HttpResponseRedirect, HttpResponse, JsonResponse, Http404
 from .models import Advertisement, Image, Comment, Like, UserStat, Preferences
 from .forms import AdvertisementForm, CommentForm, ImageForm, PreferencesForm
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.decorators.http import condition
 from django.contrib.auth import logout
 
 from django.shortcuts import render, redirect
 from .forms import SignUpForm
 from django.contrib.auth import login
-from .utilite import like_read, like_set, kandinsky_query, read_pade_count
+from . import jobs, media, render_cache, search, thumbnails, uploads
+from .pagination import KeysetPaginator, encode_cursor
+from .utilite import like_read, like_set, like_states, read_pade_count, read_version, read_stamps, \
+    page_etag, page_last_modified, remember_preferences, comments_page
 
 
 def logout_view(request: HttpRequest) -> HttpResponseRedirect:
@@ -58,14 +61,33 @@ def home(request: HttpRequest):
     return render(request, 'home.html')
 
 
+# Заголовки столбцов статистики в порядке UserStat.counters
+STAT_TITLES = ('Количество сообщений', 'Количество комментариев', 'Количество лайков', 'Количество дизлайков')
+
+
 def user_stat_list(request: HttpRequest):
     """
-    Представление - Просмотр статистики по пользователям.
+    Представление - Просмотр статистики по пользователям. Сортировка по счетчику (?sort=),
+    постраничный вывод по курсорам (?after=/?before=) и место текущего пользователя.
     :param request: HttpRequest - запрос пользователя.
     :return: Остаемся на странице.
     """
-    user_stat = UserStat.objects.all()
-    return render(request, 'board/user_statistic_list.html', {'user_stat': user_stat})
+    sort = request.GET.get('sort')
+    if sort not in UserStat.counters:
+        sort = UserStat.counters[0]
+    user_stat = UserStat.objects.select_related('user')
+    paginator = KeysetPaginator(user_stat, settings.STAT_PAGE_SIZE, count_key='stat', key=sort)
+    context = {}
+    if request.user.is_authenticated:
+        mine = UserStat.objects.filter(user=request.user).values_list(sort, 'id').first()
+        if mine:
+            # Место - количество пользователей выше в той же сортировке, считается по индексу
+            context['my_rank'] = user_stat.filter(paginator.beyond(mine, older=False)).count() + 1
+            context['my_cursor'] = encode_cursor(mine[0], mine[1] + 1)
+    page_obj = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+    return render(request, 'board/user_statistic_list.html',
+                  {'user_stat': page_obj, 'sort': sort, 'sort_titles': zip(UserStat.counters, STAT_TITLES),
+                   **context, 'render_stats': render_cache.stats()})
 
 
 def user_settings(request: HttpRequest):
@@ -75,18 +97,14 @@ def user_settings(request: HttpRequest):
     :return: Остаемся на странице.
     """
     user_stat = UserStat.objects.all()
-    try:
-        pref = Preferences.objects.get(user=request.user)
-    except BaseException as er:
-        logging.error(f'user_settings: {er}')
-        Preferences.objects.create(user=request.user)
-        pref = Preferences.objects.get(user=request.user)
+    pref, _ = Preferences.objects.get_or_create(user=request.user)
     if request.method == "POST":
         form = PreferencesForm(request.POST, request.FILES, instance=pref)
         if form.is_valid():
             user_sett = form.save(commit=False)
             user_sett.user = request.user
             user_sett.save()
+            remember_preferences(request, user_sett)
             return redirect('board:user_settings')
     else:
         form = PreferencesForm(instance=pref)
@@ -94,6 +112,14 @@ def user_settings(request: HttpRequest):
                   {'user_stat': user_stat, 'form': form})
 
 
+def feed_key(pk: int | None = None) -> str:
+    """  Ключ счетчика версии ленты: общей или выбранного автора  """
+    return f'author:{pk}' if pk else 'feed'
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request, pk=None: page_etag(request, feed_key(pk)),
+           last_modified_func=lambda request, pk=None: page_last_modified(request, feed_key(pk)))
 def advertisement_list(request: HttpRequest, pk: int | None = None):
     """
     Представление - Просмотр списка объявлений.
@@ -101,26 +127,48 @@ def advertisement_list(request: HttpRequest, pk: int | None = None):
     :param pk: id объявления.
     :return: Остаемся на странице.
     """
+    page_count = read_pade_count(request)
+    cache_key = render_cache.page_key(request, feed_key(pk), page_count)
+    if cache_key:
+        html = render_cache.render_cache().get(cache_key)
+        if html is not None:
+            render_cache.count('page_hit')
+            return HttpResponse(html)
+        render_cache.count('page_miss')
     context = {}
+    advertisements = (Advertisement.objects
+                      .select_related('author')
+                      .prefetch_related('images')
+                      .order_by('-id'))
     if pk:
-        advertisements = Advertisement.objects.filter(author=pk).order_by('-id')
-        user_stat_ = UserStat.objects.filter(user=pk)
+        advertisements = advertisements.filter(author=pk)
         context = {'user_show': User.objects.get(id=pk)}
+        user_stat_ = UserStat.objects.filter(user=pk).first()
         if user_stat_:
-            context['user_stat'] = user_stat_.first()
+            context['user_stat'] = user_stat_
+    if settings.FEED_PAGINATION == 'cursor':
+        paginator = KeysetPaginator(advertisements, page_count, count_key=pk or 'all')
+        page_obj = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
     else:
-        advertisements = Advertisement.objects.all().order_by('-id')
-    page_count = read_pade_count(request)
-    paginator = Paginator(advertisements, page_count)
-    page_num = request.GET.get('page')
-    page_obj = paginator.get_page(page_num)
-    images = []
-    for adv in range(len(page_obj)):
-        images.append(Image.objects.filter(advertisement=page_obj[adv].id))
-    context = {**context, 'advertisements': zip(page_obj, images), 'advertisements_feeds': page_obj}
-    return render(request, 'board/advertisement_list.html', context)
-
-
+        paginator = Paginator(advertisements, page_count)
+        page_obj = paginator.get_page(request.GET.get('page'))
+    # Авторы подтянуты через JOIN, картинки - одним запросом на всю страницу,
+    # карточки объявлений берутся из кеша фрагментов, оценки пользователя - одним запросом
+    reactions = like_states(request.user, [adv.id for adv in page_obj])
+    cards = [(card, adv, reactions.get(adv.id))
+             for card, adv in zip(render_cache.render_cards(request, page_obj), page_obj)]
+    context = {**context, 'cards': cards, 'advertisements_feeds': page_obj,
+               'version_key': feed_key(pk),
+               'board_version': read_stamps(request, [feed_key(pk)])[feed_key(pk)][0]}
+    response = render(request, 'board/advertisement_list.html', context)
+    if cache_key:
+        render_cache.render_cache().set(cache_key, response.content.decode())
+    return response
+
+
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request, pk: page_etag(request, f'adv:{pk}'),
+           last_modified_func=lambda request, pk: page_last_modified(request, f'adv:{pk}'))
 def advertisement_detail(request: HttpRequest, pk: int):
     """
     Представление - Просмотр выбранного объявления.
@@ -128,19 +176,111 @@ def advertisement_detail(request: HttpRequest, pk: int):
     :param pk: id объявления.
     :return: В случае нажатия кнопки Редактировать - переходим на страницу редактирования объявления.
     """
-    advertisement = Advertisement.objects.get(pk=pk)
+    advertisement = Advertisement.objects.select_related('author').get(pk=pk)
     images = Image.objects.filter(advertisement=advertisement.id)
-    comments = Comment.objects.filter(advertisement=advertisement.id)
+    # Первая страница комментариев, остальные подгружаются по кнопке "Показать еще"
+    comments, comments_next = comments_page(advertisement.id)
     context = like_read(request, pk)
     if advertisement.author == request.user or request.user.is_superuser:
-        context['reload'] = '<div id="reload"></div>'
+        context['reload'] = True
+        context['version_key'] = f'adv:{pk}'
+        context['board_version'] = read_stamps(request, [f'adv:{pk}'])[f'adv:{pk}'][0]
     return render(request, 'board/advertisement_detail.html',
                   {'advertisement': advertisement,
                    'images': images,
                    'comments': comments,
+                   'comments_next': comments_next,
                    **context})
 
 
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=lambda request, pk: page_etag(request, f'adv:{pk}'))
+def advertisement_comments(request: HttpRequest, pk: int) -> HttpResponse:
+    """
+    Представление - Следующая страница комментариев объявления ("Показать еще").
+    :param request: HttpRequest - запрос пользователя (?after= - курсор, ?format=json - ответ в JSON).
+    :param pk: id объявления.
+    :return: HTML-строки таблицы комментариев (курсор следующей страницы - в заголовке X-Next-Cursor)
+    или JSON {'comments': [...], 'next': курсор}.
+    """
+    comments, comments_next = comments_page(pk, request.GET.get('after'))
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'comments': [{'id': comment.id,
+                          'author': comment.author.username,
+                          'author_id': comment.author_id,
+                          'content': comment.content,
+                          'created_at': comment.created_at.isoformat(),
+                          'editable': comment.author_id == request.user.id or request.user.is_superuser}
+                         for comment in comments],
+            'next': comments_next})
+    response = render(request, 'board/comment_rows.html', {'comments': comments})
+    if comments_next:
+        response['X-Next-Cursor'] = comments_next
+    return response
+
+
+def board_changes(request: HttpRequest) -> JsonResponse:
+    """
+    Представление - Проверка изменений на доске для автообновления страниц.
+    Клиент передает ключ ресурса и версию, с которой была отрисована страница,
+    и перезагружает страницу только если версия изменилась.
+    :param request: HttpRequest - запрос пользователя (?key= - ресурс, ?v= - версия страницы).
+    :return: JsonResponse - текущая версия и признак изменений.
+    """
+    key = request.GET.get('key', 'board')
+    if not re.fullmatch(r'board|feed|author:\d+|adv:\d+', key):
+        return JsonResponse({'error': 'unknown key'}, status=400)
+    version = read_version(key)
+    try:
+        changed = int(request.GET.get('v', -1)) != version
+    except ValueError:
+        changed = True
+    return JsonResponse({'version': version, 'changed': changed})
+
+
+def board_search(request: HttpRequest):
+    """
+    Представление - Полнотекстовый поиск по объявлениям и комментариям.
+    :param request: HttpRequest - запрос пользователя (?q= - строка поиска, ?page= - страница).
+    :return: Страница с найденными объявлениями и комментариями.
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    per_page = settings.SEARCH_PAGE_SIZE
+    results = search.search(query, limit=per_page + 1, offset=(page - 1) * per_page)
+    return render(request, 'board/search.html',
+                  {'query': query, 'results': results[:per_page], 'page': page,
+                   'has_next': len(results) > per_page})
+
+
+def thumbnail(request: HttpRequest, size: str, name: str) -> HttpResponse:
+    """
+    Представление - Уменьшенная копия картинки. Отдает готовую копию, при необходимости
+    создает ее; пока картинка генерируется - копию заглушки (без кеширования в браузере).
+    :param request: HttpRequest - запрос пользователя.
+    :param size: Размер из settings.THUMBNAIL_SIZES.
+    :param name: Имя исходного файла относительно MEDIA_ROOT.
+    :return: Файл уменьшенной копии (или исходной картинки, если копию создать не удалось).
+    """
+    name = os.path.normpath(name).replace('\\', '/')
+    if size not in settings.THUMBNAIL_SIZES or name.startswith(('..', '/', 'thumbs/')):
+        raise Http404('Картинка не найдена')
+    source = thumbnails.source_name(name)
+    try:
+        thumbnails.generate(source, [size])
+        response = media.serve_media(request, thumbnails.thumb_name(source, size))
+    except OSError as er:
+        logging.error(f'thumbnail: {er}')
+        response = media.serve_media(request, source)
+    if source != name:
+        response['Cache-Control'] = 'no-cache'
+    return response
+
+
 @login_required
 def add_advertisement(request: HttpRequest):
     """
@@ -154,6 +294,7 @@ def add_advertisement(request: HttpRequest):
             advertisement = form.save(commit=False)
             advertisement.author = request.user
             advertisement.save()
+            thumbnails.schedule(advertisement.image.name)
             return redirect('board:advertisement_list')
     else:
         form = AdvertisementForm()
@@ -182,23 +323,40 @@ def add_comment(request: HttpRequest, pk: int):
 
 
 @login_required
+@csrf_exempt
 def add_image(request: HttpRequest, pk: int):
     """
     Представление - Добавить новые картинки.
+    Обработчик загрузки нужно подключить до чтения тела запроса, а проверка CSRF его читает,
+    поэтому она выполняется после подключения обработчика (в _add_image).
     :param request: HttpRequest - запрос пользователя.
     :param pk: id объявления.
     :return: После добавления картинок, возвращаемся к редактированию объявления.
     """
+    if request.method == "POST":
+        request.upload_handlers = [uploads.ImageUploadHandler(request)]
+    return _add_image(request, pk)
+
+
+@csrf_protect
+def _add_image(request: HttpRequest, pk: int):
+    """
+    Добавление картинок после проверки CSRF: файлы уже приняты ImageUploadHandler
+    :param request: HttpRequest - запрос пользователя.
+    :param pk: id объявления.
+    :return: Форма с ошибками загрузки или переход к редактированию объявления.
+    """
     advertisement = Advertisement.objects.get(id=pk)
+    upload_errors = []
     if request.method == "POST":
         uploaded_images = request.FILES.getlist('photo')
-        for image in uploaded_images:
-            Image.objects.create(advertisement=advertisement, user=request.user, image=image)
-        return redirect('board:edit_advertisement', pk=pk)
-    else:
-        form = ImageForm()
+        upload_errors = request.upload_handlers[0].errors
+        if not upload_errors:
+            uploads.save_images(advertisement, request.user, uploaded_images)
+            return redirect('board:edit_advertisement', pk=pk)
+    form = ImageForm()
     return render(request, 'board/add_image.html',
-                  {'form': form, 'advertisement': advertisement})
+                  {'form': form, 'advertisement': advertisement, 'upload_errors': upload_errors})
 
 
 @login_required
@@ -220,6 +378,8 @@ def edit_advertisement(request: HttpRequest, pk):
         if form.is_valid():
             advertisement = form.save(commit=False)
             advertisement.save()
+            if 'image' in form.changed_data:
+                thumbnails.schedule(advertisement.image.name)
             return redirect('board:advertisement_detail', pk=pk)
     elif request.method == "POST" and request.POST.get('image_del'):
         for img in images:
@@ -266,30 +426,14 @@ def edit_comment(request: HttpRequest, pk):
 @login_required
 def image_generation(request: HttpRequest, pk) -> HttpResponse:
     """
-    Представление - Генерация изображения с помощью API Kandinski 3.0
+    Представление - Генерация изображения с помощью API Kandinski 3.0. Генерация ставится
+    в очередь, повторные нажатия для того же объявления новых заданий не создают.
     :param request: HttpRequest - запрос пользователя.
     :param pk: id объявления.
     :return: После редактирования возвращаемся на страницу просмотра деталей выбранного объявления.
     """
     advertisement = Advertisement.objects.get(pk=pk)
-    file_name = f"img_{time.time_ns()}.jpg"
-    for i in '?!:;,*$№#%@"~`()[]{}<>':
-        file_name = file_name.replace(i, '')
-    dir_ = os.path.join(settings.MEDIA_ROOT, f'images/kandinsky/{datetime.now().year}_{datetime.now().month}').replace("\\", "/")
-    os.makedirs(dir_, exist_ok=True)
-    file = os.path.join(dir_, file_name).replace("\\", "/")
-    file_name_cut = '/'.join(file.split('/')[-4:])
-
-    Image.objects.create(advertisement=advertisement, user=request.user, image=file_name_cut)
-    src_gen = os.path.join(settings.MEDIA_ROOT, 'gen.jpg')
-    if os.path.exists(src_gen):
-        shutil.copy(src_gen, dir_)
-        os.rename(os.path.join(dir_, 'gen.jpg'), file)
-    else:
-        # gen.jpg not available; create an empty placeholder or skip
-        open(file, 'wb').close()
-    proc = Thread(target=kandinsky_query, args=(f'{advertisement.title} {advertisement.content}', dir_, file_name))
-    proc.start()
+    jobs.enqueue(advertisement, request.user)
 
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
@@ -23,6 +23,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "board.assets.StaticFilesMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -43,6 +44,7 @@ TEMPLATES = [{
             "django.template.context_processors.request",
             "django.contrib.auth.context_processors.auth",
             "django.contrib.messages.context_processors.messages",
+            "board.user_preferences.pref",
         ],
     },
 }]
@@ -52,15 +54,113 @@ WSGI_APPLICATION = "board_project.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.environ.get("SQLITE_PATH", BASE_DIR / "db.sqlite3"),
     }
 }
+# Режим SQLite для нескольких процессов gunicorn: 'concurrent' - журнал WAL (читатели не
+# блокируют писателя), ожидание блокировки, постоянные соединения и транзакции BEGIN IMMEDIATE
+# (блокировка записи берется в начале транзакции, без взаимной блокировки при повышении);
+# 'default' - настройки Django по умолчанию
+SQLITE_PROFILE = os.environ.get("SQLITE_PROFILE", "concurrent")
+if SQLITE_PROFILE == "concurrent":
+    DATABASES["default"].update({
+        "CONN_MAX_AGE": int(os.environ.get("SQLITE_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "timeout": float(os.environ.get("SQLITE_TIMEOUT", 20)),
+            "transaction_mode": "IMMEDIATE",
+            "init_command": "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL",
+        },
+    })
+# Повторы записи, получившей "database is locked", и базовая задержка между ними (сек)
+DB_LOCK_RETRIES = 5 if SQLITE_PROFILE == "concurrent" else 0
+DB_LOCK_RETRY_DELAY = 0.05
+
+# Кеш отрисованных страниц ленты: RENDER_CACHE_BACKEND=file - файловый (общий для всех
+# процессов gunicorn), иначе - в памяти процесса
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "render": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": DATA_DIR / "render_cache",
+        "TIMEOUT": 3600,
+    } if os.environ.get("RENDER_CACHE_BACKEND") == "file" else {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "render",
+        "TIMEOUT": 3600,
+    },
+}
+RENDER_CACHE = os.environ.get("RENDER_CACHE", "true").lower() == "true"
+RENDER_CACHE_ALIAS = "render"
 
 STATIC_URL = "/static/"
 STATIC_ROOT = BASE_DIR / "staticfiles"
 STATICFILES_DIRS = [BASE_DIR / "static"]
+# Время кеширования статических файлов без хеша в имени (сек); файлы с хешем кешируются навсегда
+STATIC_MAX_AGE = 3600
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+# Отдача медиафайлов (board.media): 'django' - Django с sendfile и Range, 'x-accel' - nginx
+# по X-Accel-Redirect, 'x-sendfile' - Apache/lighttpd по X-Sendfile, 'off' - фронтовый сервер напрямую
+MEDIA_SERVE = os.environ.get("MEDIA_SERVE", "django")
+# Внутренний location nginx, который указывает на MEDIA_ROOT (для 'x-accel')
+MEDIA_ACCEL_PREFIX = os.environ.get("MEDIA_ACCEL_PREFIX", "/protected-media/")
+# Время кеширования медиафайлов в браузере (сек)
+MEDIA_MAX_AGE = 86400
+# Хранилище медиафайлов: 'filesystem' - обычное, 'content' - одинаковые файлы хранятся один раз
+# (board.storage.ContentAddressedStorage, нужны жесткие ссылки в MEDIA_ROOT)
+MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "filesystem")
+STORAGES = {
+    "default": {
+        "BACKEND": "board.storage.ContentAddressedStorage" if MEDIA_STORAGE == "content"
+        else "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "board.assets.CompressedManifestStorage",
+    },
+}
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Очередь генерации картинок Kandinsky: 'thread' - обработчик запускается в веб-процессе
+# при постановке задания, 'command' - задания выполняет отдельный процесс
+# (python manage.py kandinsky_worker)
+KANDINSKY_WORKER = os.environ.get("KANDINSKY_WORKER", "thread")
+# Максимальное количество одновременных генераций
+KANDINSKY_CONCURRENCY = int(os.environ.get("KANDINSKY_CONCURRENCY", 2))
+# Через сколько секунд задание в состоянии "выполняется" считается зависшим
+KANDINSKY_JOB_TIMEOUT = 600
+# Период опроса очереди (сек)
+KANDINSKY_POLL_INTERVAL = 5
+
+# Уменьшенные копии картинок: высота в пикселях (с запасом x2 для экранов высокой плотности)
+THUMBNAIL_SIZES = {"list": 60, "detail": 600}
+# Количество процессов для фонового создания уменьшенных копий (0 - создавать сразу)
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", 2))
+
+# Загрузка картинок объявления: наибольший размер файла, количество файлов и общий размер за раз
+IMAGE_UPLOAD_MAX_SIZE = 10 * 2 ** 20
+IMAGE_UPLOAD_MAX_FILES = 20
+IMAGE_UPLOAD_MAX_TOTAL = 50 * 2 ** 20
+
+# Количество объявлений на страницу по умолчанию
+PAGE_DEFAULT = 5
+# Как долго настройки пользователя берутся из сессии без чтения из базы (сек)
+PREFERENCES_TTL = 300
+
+# Пагинация ленты: 'cursor' - по курсорам ?after=/?before=, 'page' - по номерам страниц ?page=
+FEED_PAGINATION = os.environ.get("FEED_PAGINATION", "cursor")
+# Время жизни кешированной оценки количества объявлений (сек)
+FEED_COUNT_TIMEOUT = 60
+# Количество пользователей на страницу статистики
+STAT_PAGE_SIZE = 50
+# Количество результатов на страницу поиска
+SEARCH_PAGE_SIZE = 20
+# Количество комментариев, загружаемых за раз на странице объявления
+COMMENTS_PAGE_SIZE = 20
+# JSON API: количество записей на страницу по умолчанию и наибольшее (?limit=)
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
@@ -15,10 +15,9 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
-from board import views as board_views
+from board import media, views as board_views
 
 urlpatterns = ([
     path('admin/', admin.site.urls),
@@ -27,5 +26,7 @@ urlpatterns = ([
     path('accounts/', include('django.contrib.auth.urls')),
     path('', board_views.home, name='home'),
     path('signup/', board_views.signup, name='signup'),
-] + static(settings.STATIC_URL, document_root=settings.STATICFILES_DIRS[0])
-               + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT))
+]
+               # Статические файлы отдает board.assets.StaticFilesMiddleware, медиафайлы - board.media
+               + ([path(f'{settings.MEDIA_URL.lstrip("/")}<path:path>', media.serve_media, name='media')]
+                  if settings.MEDIA_SERVE != 'off' else []))
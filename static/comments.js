@@ -0,0 +1,23 @@
+function loadMoreComments() {
+    const button = document.getElementById('comments_more');
+    const rows = document.getElementById('comments');
+    if (!button || !rows) {
+        return;
+    }
+    button.addEventListener('click', () => {
+        button.disabled = true;
+        fetch(`${button.dataset.url}?after=${encodeURIComponent(button.dataset.after)}`)
+            .then(response => response.text().then(html => {
+                rows.insertAdjacentHTML('beforeend', html);
+                const next = response.headers.get('X-Next-Cursor');
+                if (next) {
+                    button.dataset.after = next;
+                    button.disabled = false;
+                } else {
+                    button.remove();
+                }
+            }))
+            .catch(() => { button.disabled = false; });
+    });
+}
+document.addEventListener('DOMContentLoaded', loadMoreComments);
@@ -1,12 +1,25 @@
 function autoRefresh() {
     const refreshElement = document.getElementById('reload');
     if (refreshElement) {
-        setTimeout(() => {
-            location.reload(true);
-        }, 10000);
-        console.log("Страница обновляется...");
+        const url = refreshElement.dataset.url;
+        const key = refreshElement.dataset.key || 'board';
+        const version = refreshElement.dataset.version;
+        const checkChanges = () => {
+            fetch(`${url}?key=${encodeURIComponent(key)}&v=${encodeURIComponent(version)}`, {cache: 'no-store'})
+                .then(response => response.json())
+                .then(data => {
+                    if (data.changed) {
+                        console.log("Страница обновляется...");
+                        location.reload();
+                    } else {
+                        setTimeout(checkChanges, 10000);
+                    }
+                })
+                .catch(() => setTimeout(checkChanges, 30000));
+        };
+        setTimeout(checkChanges, 10000);
     } else {
         console.log("Элемент с id='reload' отсутствует.");
     }
 }
-window.onload = autoRefresh;
\ No newline at end of file
+window.onload = autoRefresh;